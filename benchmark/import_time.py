@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+冷启动导入时间的基准测试：在新的python进程中导入MAnormFast并运行`MAnormFast --help`，
+检查matplotlib, statsmodels等慢模块没有在启动时被导入，并且耗时(多次运行的中位数)不超过预算。
+超出预算时返回1，可以放在持续集成里使用:
+
+    python benchmark/import_time.py --budget 0.5
+"""
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# 启动时不应该导入的模块
+HEAVY_MODULES = ('matplotlib', 'statsmodels', 'scipy', 'pandas')
+
+_IMPORT_SNIPPET = '''
+import sys
+sys.path.insert(0, %r)
+import lib.MAnorm_io, lib.peaks
+print ' '.join(m for m in %r if m in sys.modules)
+''' % (ROOT, HEAVY_MODULES)
+
+
+def _run_time(cmd):
+    start = time.time()
+    out = subprocess.check_output(cmd)
+    return time.time() - start, out
+
+
+def median_time(cmd, repeat):
+    """
+    :return: 运行repeat次的耗时中位数(s), 最后一次运行的标准输出
+    """
+    times, out = [], ''
+    for _ in xrange(repeat):
+        elapsed, out = _run_time(cmd)
+        times.append(elapsed)
+    times.sort()
+    return times[len(times) // 2], out
+
+
+def main():
+    opt_parser = OptionParser(usage='%prog [options]')
+    opt_parser.add_option('--budget', dest='budget', type='float', default=0.5,
+                          help='cold-start budget in seconds for each command, default=0.5')
+    opt_parser.add_option('-n', dest='repeat', type='int', default=5,
+                          help='number of runs, the median is compared with the budget, default=5')
+    values = opt_parser.parse_args()[0]
+
+    failed = False
+    baseline, _ = median_time([sys.executable, '-c', 'pass'], values.repeat)
+    print 'python startup: %.3f s' % baseline
+
+    elapsed, out = median_time([sys.executable, '-c', _IMPORT_SNIPPET], values.repeat)
+    print 'import lib.MAnorm_io, lib.peaks: %.3f s' % elapsed
+    loaded = out.split()
+    if loaded:
+        print '@error: imported at startup: %s' % ', '.join(loaded)
+        failed = True
+    if elapsed > values.budget:
+        print '@error: import takes %.3f s, over the budget of %.3f s' % (elapsed, values.budget)
+        failed = True
+
+    elapsed, _ = median_time([sys.executable, os.path.join(ROOT, 'bin', 'MAnormFast'), '--help'], values.repeat)
+    print 'MAnormFast --help: %.3f s' % elapsed
+    if elapsed > values.budget:
+        print '@error: MAnormFast --help takes %.3f s, over the budget of %.3f s' % (elapsed, values.budget)
+        failed = True
+
+    if failed:
+        exit(1)
+    print 'ok'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+在不同规模的人工数据上对lib/peaks.py和lib/MAnorm_io.py的各个公开步骤计时，并与保存的基线比较。
+某个步骤比基线慢tolerance倍以上(且至少慢min-diff秒)，或者结果中的peaks数量与基线不同时返回1。
+
+    python benchmark/run_benchmark.py --scales small,medium
+    python benchmark/run_benchmark.py --scales small --save-baseline
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from lib.MAnorm_io import read_peaks, read_reads, output_normalized_peaks, output_3set_normalized_peaks, \
+    output_peaks_tracks_and_filters
+from lib.peaks import get_common_peaks, randomize_peaks, permutation_overlap_test, merge_common_peaks, \
+    cal_peaks_read_density, use_merged_peaks_fit_model, normalize_peaks, get_peaks_size
+from synthetic import SyntheticConfig, generate_dataset
+import numpy as np
+
+BASELINE_FP = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baseline.json')
+
+SCALES = {
+    'tiny': SyntheticConfig(peaks=2000, reads=200000, chrms=3, overlap=0.6),
+    'small': SyntheticConfig(peaks=10000, reads=1000000, chrms=5, overlap=0.6),
+    'medium': SyntheticConfig(peaks=50000, reads=5000000, chrms=10, overlap=0.6),
+    'large': SyntheticConfig(peaks=200000, reads=20000000, chrms=23, overlap=0.6, chrm_size=100000000),
+}
+
+# 与MAnormFast的默认参数一致
+_SHIFT, _EXT, _RANDOM_TIME = 100, 1000, 5
+
+
+def _best_time(func, repeat):
+    """
+    :return: repeat次运行中最短的耗时(s), 最后一次的返回值
+    """
+    best, result = None, None
+    for _ in xrange(repeat):
+        # 各步骤打印的信息不计入耗时，也不输出
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_scale(config, data_dir, repeat=3, processes=1):
+    """
+    按MAnormFast的流程依次对每个步骤计时
+    :return: {'timings': {步骤: 秒}, 'counts': {名称: 数量}}
+    """
+    paths = generate_dataset(config, os.path.join(data_dir, config.name()))
+    timings, counts = {}, {}
+    # read_peaks, read_reads和cal_pvalues用到时才导入pandas和scipy，先导入它们，
+    # 以免导入时间算进第一个步骤(-n 1时会被当成性能退化)
+    import pandas
+    import scipy.special
+
+    def timed(name, func):
+        timings[name], result = _best_time(func, repeat)
+        return result
+
+    pks1 = timed('read_peaks', lambda: read_peaks(paths['peaks1']))
+    pks2 = read_peaks(paths['peaks2'])
+    reads_pos1 = timed('read_reads', lambda: read_reads(paths['reads1'], _SHIFT))
+    reads_pos2 = read_reads(paths['reads2'], _SHIFT)
+    pks1_uniq, pks1_com, pks2_uniq, pks2_com = timed(
+        'get_common_peaks', lambda: get_common_peaks(pks1, pks2, processes))
+    timed('randomize_peaks', lambda: randomize_peaks(pks1, np.random.RandomState(0)))
+    timed('permutation_overlap_test', lambda: permutation_overlap_test(pks1, pks2, _RANDOM_TIME, 0))
+    merged_pks, summit_dist = timed('merge_common_peaks', lambda: merge_common_peaks(pks1_com, pks2_com, processes))
+    pks_5set = (pks1_uniq, pks1_com, pks2_uniq, pks2_com, merged_pks)
+
+    def cal_density():
+        for pks in pks_5set:
+            cal_peaks_read_density(pks, reads_pos1, reads_pos2, _EXT, processes)
+    timed('cal_peaks_read_density', cal_density)
+    ma_fit = timed('use_merged_peaks_fit_model', lambda: use_merged_peaks_fit_model(merged_pks, summit_dist, _EXT / 2))
+
+    def normalize():
+        for pks in pks_5set:
+            normalize_peaks(pks, ma_fit)
+    timed('normalize_peaks', normalize)
+
+    out_dir = tempfile.mkdtemp(prefix='manorm_bench_')
+    try:
+        os.mkdir(os.path.join(out_dir, 'wig'))
+        os.mkdir(os.path.join(out_dir, 'filters'))
+        timed('output_normalized_peaks', lambda: output_normalized_peaks(
+            pks1_uniq, pks1_com, os.path.join(out_dir, 'p1_MAvalues.xls'), 'r1', 'r2'))
+        timed('output_3set_normalized_peaks', lambda: output_3set_normalized_peaks(
+            pks1_uniq, merged_pks, pks2_uniq, os.path.join(out_dir, 'all_MAvalues.xls'), 'p1', 'p2', 'r1', 'r2'))
+        timed('output_peaks_tracks_and_filters', lambda: output_peaks_tracks_and_filters(
+            pks1_uniq, pks2_uniq, merged_pks, 'bench', 0.5, 1., 0.01, False,
+            os.path.join(out_dir, 'wig'), os.path.join(out_dir, 'filters')))
+    finally:
+        shutil.rmtree(out_dir)
+
+    counts.update({
+        'peaks1': get_peaks_size(pks1), 'peaks2': get_peaks_size(pks2),
+        'reads1': int(sum(pos.size for pos in reads_pos1.values())),
+        'reads2': int(sum(pos.size for pos in reads_pos2.values())),
+        'unique1': get_peaks_size(pks1_uniq), 'common1': get_peaks_size(pks1_com),
+        'unique2': get_peaks_size(pks2_uniq), 'common2': get_peaks_size(pks2_com),
+        'merged': get_peaks_size(merged_pks),
+    })
+    return {'config': config.to_dict(), 'timings': timings, 'counts': counts}
+
+
+def compare_with_baseline(results, baseline, tolerance, min_diff):
+    """
+    :return: 发现的问题列表，为空表示没有回退
+    """
+    problems = []
+    for scale, result in sorted(results.items()):
+        base = baseline.get(scale)
+        if base is None:
+            print '%s: no baseline' % scale
+            continue
+        if base['config'] != result['config']:
+            problems.append('%s: configuration differs from the baseline' % scale)
+            continue
+        for name, count in sorted(result['counts'].items()):
+            if base['counts'].get(name) != count:
+                problems.append('%s: %s=%d, baseline %s' % (scale, name, count, base['counts'].get(name)))
+        for name, elapsed in sorted(result['timings'].items()):
+            base_time = base['timings'].get(name)
+            if base_time is None:
+                continue
+            ratio = elapsed / base_time if base_time > 0 else float('inf')
+            flag = ''
+            if ratio > tolerance and elapsed - base_time > min_diff:
+                flag = '  <-- regression'
+                problems.append('%s: %s takes %.3f s, baseline %.3f s' % (scale, name, elapsed, base_time))
+            print '%-8s %-34s %9.3f s  baseline %9.3f s  x%.2f%s' % (scale, name, elapsed, base_time, ratio, flag)
+    return problems
+
+
+def main():
+    opt_parser = OptionParser(usage='%prog [options]')
+    opt_parser.add_option('--scales', dest='scales', default='small',
+                          help='comma separated scales among %s, default=small' % ','.join(sorted(SCALES)))
+    opt_parser.add_option('--data-dir', dest='data_dir', default=os.path.join(tempfile.gettempdir(), 'manorm_bench'),
+                          help='folder to cache the generated synthetic data')
+    opt_parser.add_option('-n', dest='repeat', type='int', default=3,
+                          help='runs of each stage, the fastest is reported, default=3')
+    opt_parser.add_option('-j', dest='processes', type='int', default=1,
+                          help='worker processes of the per-chromosome stages, default=1')
+    opt_parser.add_option('--baseline', dest='baseline', default=BASELINE_FP,
+                          help='baseline json file, default=benchmark/baseline.json')
+    opt_parser.add_option('--save-baseline', dest='save_baseline', action='store_true', default=False,
+                          help='store the results of these scales as the new baseline')
+    opt_parser.add_option('--tolerance', dest='tolerance', type='float', default=1.5,
+                          help='slowdown ratio over the baseline reported as regression, default=1.5')
+    opt_parser.add_option('--min-diff', dest='min_diff', type='float', default=0.05,
+                          help='ignore slowdowns smaller than this many seconds, default=0.05')
+    opt_parser.add_option('-o', dest='output', help='write the results as json to this file')
+    values = opt_parser.parse_args()[0]
+
+    scales = [scale.strip() for scale in values.scales.split(',') if scale.strip()]
+    for scale in scales:
+        if scale not in SCALES:
+            opt_parser.error('unknown scale "%s"' % scale)
+    results = {}
+    for scale in scales:
+        print 'running %s ...' % scale
+        results[scale] = run_scale(SCALES[scale], values.data_dir, values.repeat, values.processes)
+    if values.output is not None:
+        with open(values.output, 'w') as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+
+    baseline = {}
+    if os.path.exists(values.baseline):
+        with open(values.baseline) as fi:
+            baseline = json.load(fi)
+    if values.save_baseline:
+        baseline.update(results)
+        with open(values.baseline, 'w') as fo:
+            json.dump(baseline, fo, indent=2, sort_keys=True)
+        print 'baseline saved to %s' % values.baseline
+        return
+    problems = compare_with_baseline(results, baseline, values.tolerance, values.min_diff)
+    if problems:
+        for problem in problems:
+            print '@error: ' + problem
+        exit(1)
+    print 'ok'
+
+
+if __name__ == '__main__':
+    main()
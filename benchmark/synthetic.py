@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+生成可重复的人工数据：两组peak文件(chr, start, end, summit相对于start)和两组bed格式的reads文件。
+同样的参数和随机种子总是生成完全一样的文件。
+
+    python benchmark/synthetic.py -o synthetic_data --peaks 50000 --reads 5000000 --chrms 10 --overlap 0.6
+"""
+import os
+from optparse import OptionParser
+
+import numpy as np
+
+# 每个peak中富集的reads所占的比例，其余的reads均匀分布在整个基因组上
+_ENRICHED_FRACTION = 0.6
+# 写文件时每次格式化的行数
+_WRITE_CHUNK_SIZE = 1 << 16
+
+
+class SyntheticConfig(object):
+    """
+    人工数据的参数
+    :param peaks: 每组peak的数量
+    :param reads: 每组reads的数量
+    :param chrms: 染色体数量
+    :param overlap: 第二组peak中与第一组重叠的比例
+    :param chrm_size: 每条染色体的长度
+    :param seed: 随机种子
+    """
+    def __init__(self, peaks=10000, reads=1000000, chrms=5, overlap=0.6, chrm_size=50000000, seed=0):
+        self.peaks = peaks
+        self.reads = reads
+        self.chrms = chrms
+        self.overlap = overlap
+        self.chrm_size = chrm_size
+        self.seed = seed
+
+    def to_dict(self):
+        return {'peaks': self.peaks, 'reads': self.reads, 'chrms': self.chrms, 'overlap': self.overlap,
+                'chrm_size': self.chrm_size, 'seed': self.seed}
+
+    def name(self):
+        return 'p%d_r%d_c%d_o%g_l%d_s%d' % (self.peaks, self.reads, self.chrms, self.overlap, self.chrm_size,
+                                            self.seed)
+
+
+def _random_peaks(rng, n, chrms, chrm_size):
+    """
+    :return: chrm下标, start, end, summit(绝对位置)
+    """
+    chrm_idx = rng.randint(0, chrms, n)
+    widths = rng.randint(200, 2000, n)
+    starts = rng.randint(0, chrm_size - 2000, n)
+    summits = starts + (widths * rng.uniform(0.2, 0.8, n)).astype(np.int64)
+    return chrm_idx, starts, starts + widths, summits
+
+
+def _shifted_peaks(rng, chrm_idx, starts, ends, summits):
+    """
+    以已有的peaks为基础生成与之重叠、但位置和宽度略有不同的peaks
+    """
+    widths = ends - starts
+    offsets = (widths * rng.uniform(-0.4, 0.4, starts.size)).astype(np.int64)
+    new_starts = np.maximum(starts + offsets, 0)
+    new_widths = (widths * rng.uniform(0.7, 1.3, starts.size)).astype(np.int64) + 1
+    new_summits = new_starts + (new_widths * rng.uniform(0.2, 0.8, starts.size)).astype(np.int64)
+    return chrm_idx.copy(), new_starts, new_starts + new_widths, new_summits
+
+
+def generate_peaks(config):
+    """
+    :return: (peaks1, peaks2)，每组都是(chrm下标, start, end, summit)
+    """
+    rng = np.random.RandomState(config.seed)
+    peaks1 = _random_peaks(rng, config.peaks, config.chrms, config.chrm_size)
+    n_common = int(config.peaks * config.overlap)
+    common = rng.choice(config.peaks, n_common, replace=False)
+    shifted = _shifted_peaks(rng, *[col[common] for col in peaks1])
+    unique = _random_peaks(rng, config.peaks - n_common, config.chrms, config.chrm_size)
+    peaks2 = tuple(np.concatenate([s, u]) for s, u in zip(shifted, unique))
+    return peaks1, peaks2
+
+
+def generate_reads(config, peaks, seed_offset):
+    """
+    一部分reads按peak summit附近的正态分布富集(每个peak的富集程度不同)，其余均匀分布
+    :return: chrm下标, start, end, strand('+'或'-')
+    """
+    rng = np.random.RandomState(config.seed + seed_offset)
+    chrm_idx, starts, ends, summits = peaks
+    n_enriched = int(config.reads * _ENRICHED_FRACTION)
+    weights = rng.gamma(2.0, 1.0, summits.size)
+    picked = rng.choice(summits.size, n_enriched, p=weights / weights.sum())
+    centers = np.concatenate([
+        summits[picked] + rng.normal(0, 150, n_enriched).astype(np.int64),
+        rng.randint(0, config.chrm_size, config.reads - n_enriched)
+    ])
+    read_chrms = np.concatenate([chrm_idx[picked], rng.randint(0, config.chrms, config.reads - n_enriched)])
+    read_starts = np.clip(centers - 18, 0, config.chrm_size - 36)
+    strands = np.where(rng.randint(0, 2, config.reads) == 1, '+', '-')
+    order = np.lexsort((read_starts, read_chrms))
+    return read_chrms[order], read_starts[order], read_starts[order] + 36, strands[order]
+
+
+def _chrm_names(chrms):
+    return ['chr%d' % (i + 1) for i in xrange(chrms)]
+
+
+def write_peaks(peaks_fp, peaks, chrms):
+    chrm_idx, starts, ends, summits = peaks
+    order = np.lexsort((starts, chrm_idx))
+    names = np.array(_chrm_names(chrms), dtype=object)
+    rows = zip(names[chrm_idx[order]].tolist(), starts[order].tolist(), ends[order].tolist(),
+               (summits - starts)[order].tolist())
+    with open(peaks_fp, 'w') as fo:
+        for i in xrange(0, len(rows), _WRITE_CHUNK_SIZE):
+            fo.write(''.join('%s\t%d\t%d\t%d\n' % row for row in rows[i:i + _WRITE_CHUNK_SIZE]))
+
+
+def write_reads(reads_fp, reads, chrms):
+    chrm_idx, starts, ends, strands = reads
+    names = np.array(_chrm_names(chrms), dtype=object)
+    with open(reads_fp, 'w') as fo:
+        for i in xrange(0, starts.size, _WRITE_CHUNK_SIZE):
+            part = slice(i, i + _WRITE_CHUNK_SIZE)
+            rows = zip(names[chrm_idx[part]].tolist(), starts[part].tolist(), ends[part].tolist(),
+                       strands[part].tolist())
+            fo.write(''.join('%s\t%d\t%d\tr\t0\t%s\n' % row for row in rows))
+
+
+def generate_dataset(config, out_dir):
+    """
+    在out_dir下生成peaks1.bed, peaks2.bed, reads1.bed, reads2.bed，已经生成过的文件不会重新生成
+    :return: {'peaks1': 路径, 'peaks2': ..., 'reads1': ..., 'reads2': ...}
+    """
+    paths = {name: os.path.join(out_dir, name + '.bed') for name in ('peaks1', 'peaks2', 'reads1', 'reads2')}
+    done_fp = os.path.join(out_dir, '.done')
+    if os.path.exists(done_fp):
+        return paths
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    peaks1, peaks2 = generate_peaks(config)
+    write_peaks(paths['peaks1'], peaks1, config.chrms)
+    write_peaks(paths['peaks2'], peaks2, config.chrms)
+    write_reads(paths['reads1'], generate_reads(config, peaks1, 1), config.chrms)
+    write_reads(paths['reads2'], generate_reads(config, peaks2, 2), config.chrms)
+    open(done_fp, 'w').close()
+    return paths
+
+
+def main():
+    opt_parser = OptionParser(usage='%prog -o out_dir [options]')
+    opt_parser.add_option('-o', dest='out_dir', help='output folder of the synthetic files')
+    opt_parser.add_option('--peaks', dest='peaks', type='int', default=10000, help='peaks per set, default=10000')
+    opt_parser.add_option('--reads', dest='reads', type='int', default=1000000, help='reads per set, default=1000000')
+    opt_parser.add_option('--chrms', dest='chrms', type='int', default=5, help='number of chromosomes, default=5')
+    opt_parser.add_option('--overlap', dest='overlap', type='float', default=0.6,
+                          help='fraction of peaks2 overlapping peaks1, default=0.6')
+    opt_parser.add_option('--chrm-size', dest='chrm_size', type='int', default=50000000,
+                          help='length of each chromosome, default=50000000')
+    opt_parser.add_option('--seed', dest='seed', type='int', default=0, help='random seed, default=0')
+    values = opt_parser.parse_args()[0]
+    if values.out_dir is None:
+        opt_parser.error('-o is required')
+    config = SyntheticConfig(values.peaks, values.reads, values.chrms, values.overlap, values.chrm_size, values.seed)
+    for name, path in sorted(generate_dataset(config, values.out_dir).items()):
+        print '%s: %s' % (name, path)
+
+
+if __name__ == '__main__':
+    main()
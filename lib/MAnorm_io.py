@@ -1,38 +1,282 @@
 # coding=utf-8
 # MAnorm的输入输出都在这个脚本里面处理
-from numpy.ma import log2, log10
-import matplotlib
+import gzip
+import hashlib
+import json
+import os
+import sys
+from array import array
 
-from peaks import Peak, get_peaks_mavalues, get_peaks_normed_mavalues, \
-    get_peaks_pvalues, _add_peaks, _sort_peaks_list
+from parallel import map_tasks
+from peaks import PeakTable, get_peaks_mavalues, get_peaks_normed_mavalues, rescale_log2_density
 
-matplotlib.use('Agg')
-from matplotlib import pyplot as plt
 import numpy as np
 
+# matplotlib, pandas, scipy和statsmodels导入都很慢，只在用到的函数里导入，
+# 这样--help, --version和不作图的运行不需要导入它们
 
-def _get_reads_position(reads_fp, shift):
+
+# 解析reads文件时每个分块的内存上限(MB)，以及估算的每行解析后所占的内存(字节)
+READS_CHUNK_MEMORY = 256
+_READS_ROW_BYTES = 200
+
+
+def _iter_reads_chunks(reads_fp, chunk_memory=READS_CHUNK_MEMORY):
+    """
+    分块读取bed格式的reads文件，.gz结尾的文件按gzip解压
+    :param chunk_memory: 每个分块的内存上限(MB)
+    :return: 每次返回一个只含chr, start, end, strand四列的DataFrame
+    """
+    import pandas as pd
+    chunk_size = max(1, int(chunk_memory * 1024 * 1024 / _READS_ROW_BYTES))
+    return pd.read_csv(
+        reads_fp, sep='\t', header=None, usecols=[0, 1, 2, 5],
+        dtype={0: str, 1: np.int64, 2: np.int64, 5: str},
+        compression='gzip' if reads_fp.endswith('.gz') else None,
+        chunksize=chunk_size
+    )
+
+
+# BAM/SAM文件的后缀
+ALIGNMENT_SUFFIXES = ('.bam', '.sam')
+# 跳过没有比对上(0x4)、secondary(0x100)和supplementary(0x800)的记录，去重时再跳过标记为duplicate(0x400)的记录
+_SKIP_FLAGS = 0x4 | 0x100 | 0x800
+_DUP_FLAG = 0x400
+_REVERSE_FLAG = 0x10
+
+
+class AlignmentOptions(object):
+    """
+    读取BAM/SAM文件时的过滤条件和解压线程数
+    :param min_mapq: 最小的比对质量
+    :param remove_dup: 是否去掉标记为duplicate的reads
+    :param threads: BGZF解压的线程数
+    """
+    def __init__(self, min_mapq=0, remove_dup=False, threads=1):
+        self.min_mapq = min_mapq
+        self.remove_dup = remove_dup
+        self.threads = threads
+
+    def skip_flags(self):
+        return _SKIP_FLAGS | _DUP_FLAG if self.remove_dup else _SKIP_FLAGS
+
+    def index_tag(self):
+        """
+        过滤条件不同时位点也不同，索引文件名和索引的键中要加上过滤条件
+        """
+        return 'q%d%s' % (self.min_mapq, '.nodup' if self.remove_dup else '')
+
+
+def is_alignment_file(reads_fp):
+    return reads_fp.lower().endswith(ALIGNMENT_SUFFIXES)
+
+
+def _is_indexed_bam(reads_fp):
+    if not reads_fp.lower().endswith('.bam'):
+        return False
+    return any(os.path.exists(index_fp) for index_fp in (reads_fp + '.bai', reads_fp + '.csi', reads_fp[:-4] + '.bai'))
+
+
+def _open_alignment(reads_fp, options):
+    try:
+        import pysam
+    except ImportError:
+        raise ImportError('reading BAM/SAM files needs pysam, please install it or convert "%s" to bed' % reads_fp)
+    mode = 'rb' if reads_fp.lower().endswith('.bam') else 'r'
+    return pysam.AlignmentFile(reads_fp, mode, threads=options.threads)
+
+
+def _alignment_contigs(alignment):
+    """
+    :return: 有索引的BAM文件中有reads的染色体，没有索引时返回None
+    """
+    if not alignment.is_bam or not alignment.has_index():
+        return None
+    return [stat.contig for stat in alignment.get_index_statistics() if stat.total > 0]
+
+
+def _iter_alignment_blocks(reads, shift, options):
+    """
+    取出每条read的5'端位置并按链平移(正链start + shift, 负链end - shift，与bed文件相同)，
+    连续的同一条染色体上的reads作为一块返回
+    :return: 生成(reference_id, int32位点数组)
+    """
+    skip_flags, min_mapq = options.skip_flags(), options.min_mapq
+    current, block = -1, array('i')
+    for read in reads:
+        flag = read.flag
+        if flag & skip_flags or read.mapping_quality < min_mapq:
+            continue
+        if read.reference_id != current:
+            if len(block) > 0:
+                yield current, np.frombuffer(block, dtype=np.int32)
+            current, block = read.reference_id, array('i')
+        block.append(read.reference_end - shift if flag & _REVERSE_FLAG else read.reference_start + shift)
+    if len(block) > 0:
+        yield current, np.frombuffer(block, dtype=np.int32)
+
+
+def _alignment_contig_position(reads_fp, shift, options, contig):
+    """
+    用索引只读取一条染色体上的reads
+    :return: 升序的int32位点数组
+    """
+    alignment = _open_alignment(reads_fp, options)
+    try:
+        parts = [pos for _, pos in _iter_alignment_blocks(alignment.fetch(contig), shift, options)]
+    finally:
+        alignment.close()
+    return _finish_chrm_position(parts) if parts else np.zeros(0, dtype=np.int32)
+
+
+def _alignment_contig_task(args):
+    return _alignment_contig_position(*args)
+
+
+def _get_alignment_position(reads_fp, shift, options=None, processes=1):
+    """
+    从BAM/SAM文件中读取所有reads的位点。有索引的BAM文件在processes > 1时按染色体分区域并行读取
+    :return: {chrm: 升序的int32数组}
+    """
+    options = options or AlignmentOptions()
+    alignment = _open_alignment(reads_fp, options)
+    try:
+        contigs = _alignment_contigs(alignment)
+        if contigs is not None and processes > 1:
+            alignment.close()
+            tasks = [(reads_fp, shift, options, contig) for contig in contigs]
+            return dict(zip(contigs, map_tasks(_alignment_contig_task, tasks, processes)))
+        position = {}
+        for rid, pos in _iter_alignment_blocks(alignment.fetch(until_eof=True), shift, options):
+            position.setdefault(alignment.get_reference_name(rid), []).append(pos)
+    finally:
+        alignment.close()
+    for chrm in position.keys():
+        position[chrm] = _finish_chrm_position(position[chrm])
+    return position
+
+
+def _iter_alignment_position(reads_fp, shift, options=None):
+    """
+    流式模式下逐条染色体读取BAM/SAM文件，有索引时按染色体fetch，否则要求文件按坐标排序
+    :return: 生成(chrm, 升序的int32位点数组)
+    """
+    options = options or AlignmentOptions()
+    alignment = _open_alignment(reads_fp, options)
+    try:
+        contigs = _alignment_contigs(alignment)
+        if contigs is not None:
+            for contig in contigs:
+                yield contig, _alignment_contig_position(reads_fp, shift, options, contig)
+            return
+        current, parts, finished = None, [], set()
+        for rid, pos in _iter_alignment_blocks(alignment.fetch(until_eof=True), shift, options):
+            chrm = alignment.get_reference_name(rid)
+            if chrm != current:
+                if current is not None:
+                    yield current, _finish_chrm_position(parts)
+                    finished.add(current)
+                if chrm in finished:
+                    raise ValueError('alignment file "%s" is not sorted by coordinate, %s appears again' %
+                                     (reads_fp, chrm))
+                current, parts = chrm, []
+            parts.append(pos)
+        if current is not None:
+            yield current, _finish_chrm_position(parts)
+    finally:
+        alignment.close()
+
+
+def _get_reads_position(reads_fp, shift, chunk_memory=READS_CHUNK_MEMORY, bam_options=None, processes=1):
+    """
+    按文件后缀读取bed或BAM/SAM格式的reads的位点
+    :return: {chrm: 升序的int32数组}
+    """
+    if is_alignment_file(reads_fp):
+        return _get_alignment_position(reads_fp, shift, bam_options, processes)
+    return _get_bed_reads_position(reads_fp, shift, chunk_memory)
+
+
+def _get_bed_reads_position(reads_fp, shift, chunk_memory=READS_CHUNK_MEMORY):
     """
     从read文件中获取所有read的点位置信息，我们将read的位置当成点来处理。
-    read文件要求前三列是chr, start, end,第六列是strand(bed格式), 列之间以\t分隔
+    read文件要求前三列是chr, start, end,第六列是strand(bed格式), 列之间以\t分隔，可以是gzip压缩的
     :param shift: <int>平移量
     :param reads_fp: read文件路径
-    :return: 所有read记录的位点
+    :param chunk_memory: 分块解析时每块的内存上限(MB)
+    :return: 所有read记录的位点, {chrm: 升序的int32数组}
     """
+    import pandas as pd
     position = {}
-    with open(reads_fp) as fi:
-        for li in fi:
-            sli = li.split('\t')
-            chrm, start, end, strand = \
-                sli[0].strip(), int(sli[1]), int(sli[2]), sli[5].strip()
-            pos = start + shift if strand is '+' else end - shift
+    for chunk in _iter_reads_chunks(reads_fp, chunk_memory):
+        chrms, starts, ends, strands = [chunk[col].values for col in chunk.columns]
+        pos = np.where(strands == '+', starts + shift, ends - shift).astype(np.int32)
+        # 按染色体把这一块的位点分组
+        codes, names = pd.factorize(chrms)
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.cumsum(np.bincount(codes, minlength=len(names)))[:-1]
+        for chrm, chrm_pos in zip(names, np.split(pos[order], bounds)):
             try:
-                position[chrm].append(pos)
+                position[chrm].append(chrm_pos)
             except KeyError:
-                position[chrm] = []
-                position[chrm].append(pos)
+                position[chrm] = [chrm_pos]
     # 返回排序后的reads的位点信息
-    return {key: sorted(position[key]) for key in position.keys()}
+    for chrm in position.keys():
+        position[chrm] = _finish_chrm_position(position[chrm])
+    return position
+
+
+def _finish_chrm_position(parts):
+    chrm_pos = np.concatenate(parts) if len(parts) > 1 else parts[0]
+    chrm_pos.sort()
+    return chrm_pos
+
+
+def _iter_sorted_reads_position(reads_fp, shift, chunk_memory=READS_CHUNK_MEMORY):
+    """
+    逐条染色体解析按染色体排序(同一染色体的reads连续出现)的reads文件，
+    内存中只保留当前染色体的位点和一个分块
+    :return: 生成(chrm, 升序的int32位点数组)
+    """
+    current, parts, finished = None, [], set()
+    for chunk in _iter_reads_chunks(reads_fp, chunk_memory):
+        chrms, starts, ends, strands = [chunk[col].values for col in chunk.columns]
+        pos = np.where(strands == '+', starts + shift, ends - shift).astype(np.int32)
+        bounds = np.concatenate(([0], np.flatnonzero(chrms[1:] != chrms[:-1]) + 1, [chrms.size]))
+        for b0, b1 in zip(bounds[:-1], bounds[1:]):
+            chrm = chrms[b0]
+            if chrm != current:
+                if current is not None:
+                    yield current, _finish_chrm_position(parts)
+                    finished.add(current)
+                if chrm in finished:
+                    raise ValueError('reads file "%s" is not sorted by chromosome, %s appears again' %
+                                     (reads_fp, chrm))
+                current, parts = chrm, []
+            parts.append(pos[b0:b1])
+    if current is not None:
+        yield current, _finish_chrm_position(parts)
+
+
+def iter_reads_by_chrm(reads_fp, shift, chunk_memory=READS_CHUNK_MEMORY, use_index=False, index_dir=None,
+                       bam_options=None):
+    """
+    流式模式下逐条染色体读取reads的位点。有可用的索引时按染色体访问内存映射的索引；
+    BAM文件有.bai索引时按染色体fetch；否则要求reads文件按染色体排序(比如sort -k1,1 -k2,2n)，边解析边返回
+    :return: 生成(chrm, 升序的位点数组)
+    """
+    if use_index:
+        position = load_reads_index(reads_fp, shift, index_dir, bam_options)
+        if position is not None:
+            for chrm in sorted(position.keys()):
+                yield chrm, position[chrm]
+            return
+    if is_alignment_file(reads_fp):
+        chrm_iter = _iter_alignment_position(reads_fp, shift, bam_options)
+    else:
+        chrm_iter = _iter_sorted_reads_position(reads_fp, shift, chunk_memory)
+    for chrm, chrm_pos in chrm_iter:
+        yield chrm, chrm_pos
 
 
 def _get_read_length(reads_fp):
@@ -47,167 +291,433 @@ def _get_read_length(reads_fp):
             return int(sli[2]) - int(sli[1])
 
 
-def read_reads(reads_fp, shift):
-    return _get_reads_position(reads_fp, shift)
+# reads位点索引文件的格式版本
+_READS_INDEX_VERSION = 1
 
 
-def _read_peaks(peak_fp):
+def _reads_filter_tag(reads_fp, bam_options=None):
     """
-    peak文件要求前三列分别是chrm, start, end. 可以有第四列summit,
-    summit要求是相对于start的位置（和macs的结果一样）
-    以#开头的行会跳过，列之间用制表符分隔开
-    :param peak_fp: peak文件路径
-    :return: Peak的字典
+    :return: BAM/SAM文件的过滤条件标记，bed文件为空字符串
     """
-    pks = {}
-    with open(peak_fp) as fi:
-        for li in fi:
-            if li.startswith('#'):
-                continue
-            sli = li.split('\t')
-            chrm = sli[0].strip()
-            try:
-                # pk = Peak(chrm, int(sli[1]), int(sli[2]))
-                pk = Peak(chrm, int(sli[1]), int(sli[2]), int(sli[3].strip()))
-            except:
-                pk = Peak(chrm, int(sli[1]), int(sli[2]))
-            try:
-                pks[chrm].append(pk)
-            except KeyError:
-                pks[chrm] = []
-                pks[chrm].append(pk)
-    return pks
+    if not is_alignment_file(reads_fp):
+        return ''
+    return (bam_options or AlignmentOptions()).index_tag()
+
+
+def _reads_index_paths(reads_fp, shift, index_dir=None, bam_options=None):
+    """
+    reads位点索引由两个文件组成：所有染色体位点首尾相连的.npy文件和记录染色体偏移量的.json文件。
+    默认放在reads文件旁边，指定index_dir时放在index_dir中，文件名中加入reads文件绝对路径的hash以区分同名文件
+    :return: .npy文件路径, .json文件路径
+    """
+    if index_dir is None:
+        prefix = reads_fp
+    else:
+        path_hash = hashlib.md5(os.path.abspath(reads_fp)).hexdigest()[:8]
+        prefix = os.path.join(index_dir, '%s_%s' % (os.path.basename(reads_fp), path_hash))
+    tag = _reads_filter_tag(reads_fp, bam_options)
+    prefix = '%s.shift%d%s.mfidx' % (prefix, shift, '.' + tag if tag else '')
+    return prefix + '.npy', prefix + '.json'
+
+
+def _reads_index_key(reads_fp, shift, bam_options=None):
+    """
+    索引的键：reads文件的绝对路径、修改时间、大小、平移量和BAM/SAM的过滤条件，任何一个变化索引都会失效
+    """
+    stat = os.stat(reads_fp)
+    key = {'path': os.path.abspath(reads_fp), 'mtime': stat.st_mtime, 'size': stat.st_size,
+           'shift': shift, 'version': _READS_INDEX_VERSION}
+    tag = _reads_filter_tag(reads_fp, bam_options)
+    if tag:
+        key['filter'] = tag
+    return key
+
+
+def write_reads_index(reads_fp, shift, position, index_dir=None, bam_options=None):
+    """
+    把排好序的reads位点写成索引文件
+    :param position: {chrm: 升序的int32数组}
+    :return: 索引的.npy文件路径
+    """
+    npy_fp, meta_fp = _reads_index_paths(reads_fp, shift, index_dir, bam_options)
+    if index_dir is not None and not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    chrms = sorted(position.keys())
+    offsets = [0]
+    for chrm in chrms:
+        offsets.append(offsets[-1] + len(position[chrm]))
+    data = np.concatenate([position[chrm] for chrm in chrms]) if chrms else np.zeros(0)
+    meta = _reads_index_key(reads_fp, shift, bam_options)
+    meta['chrms'], meta['offsets'] = chrms, offsets
+    # 先写临时文件再改名，.json最后写入，避免其他运行读到写了一半的索引
+    tmp_fp = '%s.tmp%d' % (npy_fp, os.getpid())
+    with open(tmp_fp, 'wb') as fo:
+        np.save(fo, data.astype(np.int32, copy=False))
+    os.rename(tmp_fp, npy_fp)
+    tmp_fp = '%s.tmp%d' % (meta_fp, os.getpid())
+    with open(tmp_fp, 'w') as fo:
+        json.dump(meta, fo)
+    os.rename(tmp_fp, meta_fp)
+    return npy_fp
+
+
+def load_reads_index(reads_fp, shift, index_dir=None, bam_options=None):
+    """
+    以内存映射的方式读取reads位点索引
+    :return: {chrm: 升序的int32数组}，索引不存在或已经过期时返回None
+    """
+    npy_fp, meta_fp = _reads_index_paths(reads_fp, shift, index_dir, bam_options)
+    try:
+        with open(meta_fp) as fi:
+            meta = json.load(fi)
+        data = np.load(npy_fp, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    key = _reads_index_key(reads_fp, shift, bam_options)
+    if any(meta.get(name) != value for name, value in key.items()):
+        return None
+    offsets = meta['offsets']
+    return {str(chrm): data[offsets[i]:offsets[i + 1]] for i, chrm in enumerate(meta['chrms'])}
+
+
+def build_reads_index(reads_fp, shift, chunk_memory=READS_CHUNK_MEMORY, index_dir=None, bam_options=None,
+                      processes=1):
+    """
+    解析reads文件并写入索引，索引已是最新时不重复解析
+    :return: 索引的.npy文件路径, 是否重新生成了索引
+    """
+    if load_reads_index(reads_fp, shift, index_dir, bam_options) is not None:
+        return _reads_index_paths(reads_fp, shift, index_dir, bam_options)[0], False
+    position = _get_reads_position(reads_fp, shift, chunk_memory, bam_options, processes)
+    return write_reads_index(reads_fp, shift, position, index_dir, bam_options), True
+
+
+def read_reads(reads_fp, shift, chunk_memory=READS_CHUNK_MEMORY, use_index=False, index_dir=None, bam_options=None,
+               processes=1):
+    """
+    读取bed或BAM/SAM格式的reads的位点。use_index为True时优先内存映射已有的索引，
+    索引不存在或已过期时解析reads文件并写入索引
+    :param bam_options: 读取BAM/SAM文件时的AlignmentOptions
+    :param processes: 有索引的BAM文件按染色体并行读取的进程数
+    :return: {chrm: 升序的int32数组}
+    """
+    if not use_index:
+        return _get_reads_position(reads_fp, shift, chunk_memory, bam_options, processes)
+    position = load_reads_index(reads_fp, shift, index_dir, bam_options)
+    if position is None:
+        position = _get_reads_position(reads_fp, shift, chunk_memory, bam_options, processes)
+        try:
+            write_reads_index(reads_fp, shift, position, index_dir, bam_options)
+        except (IOError, OSError) as e:
+            print '@warning: could not write reads index of "%s": %s' % (reads_fp, e)
+    return position
+
+
+def _read_reads_task(args):
+    """
+    子进程中解析一个reads文件。写入索引成功时只返回None，由父进程内存映射索引，
+    避免把位点数组pickle后传回父进程
+    """
+    reads_fp, shift, chunk_memory, use_index, index_dir, bam_options = args
+    if use_index and load_reads_index(reads_fp, shift, index_dir, bam_options) is not None:
+        return None
+    position = _get_reads_position(reads_fp, shift, chunk_memory, bam_options)
+    if use_index:
+        try:
+            write_reads_index(reads_fp, shift, position, index_dir, bam_options)
+            return None
+        except (IOError, OSError) as e:
+            print '@warning: could not write reads index of "%s": %s' % (reads_fp, e)
+    return position
+
+
+def read_reads_files(reads_list, chunk_memory=READS_CHUNK_MEMORY, use_index=False, index_dir=None, processes=1,
+                     bam_options=None):
+    """
+    读取多个reads文件，多进程时每个文件由一个子进程解析；
+    有索引的BAM文件在当前进程中逐个读取，每个文件内按染色体分区域并行
+    :param reads_list: [(reads_fp, shift), ...]
+    :param processes: 进程数
+    :return: 与reads_list对应的位点字典列表
+    """
+    if processes <= 1:
+        return [read_reads(reads_fp, shift, chunk_memory, use_index, index_dir, bam_options)
+                for reads_fp, shift in reads_list]
+    positions = {}
+    file_tasks = []
+    for reads_fp, shift in reads_list:
+        if _is_indexed_bam(reads_fp):
+            positions[(reads_fp, shift)] = read_reads(
+                reads_fp, shift, chunk_memory, use_index, index_dir, bam_options, processes)
+        else:
+            file_tasks.append((reads_fp, shift, chunk_memory, use_index, index_dir, bam_options))
+    for task, position in zip(file_tasks, map_tasks(_read_reads_task, file_tasks, processes)):
+        reads_fp, shift = task[:2]
+        if position is None:
+            position = load_reads_index(reads_fp, shift, index_dir, bam_options)
+        positions[(reads_fp, shift)] = position
+    return [positions[(reads_fp, shift)] for reads_fp, shift in reads_list]
+
+
+# 能识别的peak文件格式：summit所在的列(从0开始)，以及summit是相对于start的位置还是绝对位置
+PEAK_FORMATS = {
+    'bed3': (None, False),
+    'bed4': (3, False),
+    'narrowPeak': (9, False),
+    'macs_xls': (4, False),
+    'macs2_xls': (4, True),
+}
+_PEAK_HEADER_PREFIXES = ('#', 'track', 'browser')
+
+
+def _open_text(file_fp):
+    return gzip.open(file_fp, 'rb') if file_fp.endswith('.gz') else open(file_fp)
+
 
+def _is_int(field):
+    return field.lstrip('+-').isdigit()
 
-def _read_macs_xls_peaks(peak_fp):
-    """
-    macs xls peak的格式如下：
-    # This file is generated by MACS
-    # ARGUMENTS LIST:
-    # name = H1hesc_H3K27ac
-    # format = BED
-    # ChIP-seq file = ERR361900_H1hesc_H3K27ac.bed
-    # control file = ERR361907_H1hESCs_input.bed
-    # effective genome size = 2.70e+09
-    # tag size = 33
-    # band width = 300
-    # model fold = 32
-    # pvalue cutoff = 1.00e-05
-    # Ranges for calculating regional lambda are : peak_region,1000,5000,10000
-    # unique tags in treatment: 20362172
-    # total tags in treatment: 23716419
-    # unique tags in control: 17987977
-    # total tags in control: 19711008
-    # d = 164
-    chr     start   end     length  summit  tags    -10*log10(pvalue)       fold_enrichment FDR(%)
-    chr1    713915  714866  952     555     115     472.37  18.43   5.33
-    chr1    761943  763542  1600    1306    204     373.20  10.53   8.45
-    chr1    839510  840672  1163    449     77      69.35   5.60    100
-    :param peak_fp: macs xls peaks file path
-    :return: peaks字典
-    """
-    pks = {}
-    with open(peak_fp) as fi:
+
+def detect_peaks_format(peak_fp):
+    """
+    根据第一行数据(和MACS xls的表头)判断peak文件的格式：
+    bed3: chrm, start, end，summit取peak的中心
+    bed4: 第四列是相对于start的summit(也可以是名字等其它内容)
+    narrowPeak: ENCODE narrowPeak，第十列是相对于start的summit，-1表示没有summit
+    macs_xls: MACS 1.4的xls，第五列summit是相对于start的位置
+    macs2_xls: MACS2的xls，第五列abs_summit是绝对位置
+    以#, track, browser开头的行和空行会跳过
+    :return: 格式名(没有数据时为None，包括只有表头的MACS xls), 数据之前要跳过的行数
+    """
+    skip_rows = 0
+    header_format = None
+    with _open_text(peak_fp) as fi:
         for li in fi:
-            if li.startswith('#'):
+            if not li.strip() or li.startswith(_PEAK_HEADER_PREFIXES):
+                skip_rows += 1
                 continue
-            sli = li.split('\t')
-            chrm = sli[0].strip()
-            try:
-                # pk = Peak(chrm, int(sli[1]), int(sli[2]))
-                pk = Peak(chrm, int(sli[1]), int(sli[2]), int(sli[4]))
-            except:
+            if header_format is not None:
+                return header_format, skip_rows
+            sli = [x.strip() for x in li.rstrip('\r\n').split('\t')]
+            if sli[0] == 'chr' and len(sli) > 4 and sli[1] == 'start':
+                # MACS xls的表头，后面还要有数据行
+                header_format = 'macs2_xls' if sli[4] == 'abs_summit' else 'macs_xls'
+                skip_rows += 1
                 continue
-            try:
-                pks[chrm].append(pk)
-            except KeyError:
-                pks[chrm] = []
-                pks[chrm].append(pk)
+            if peak_fp.endswith('.xls') and len(sli) > 4:
+                return 'macs_xls', skip_rows
+            if len(sli) >= 10 and _is_int(sli[9]) and (
+                    '.narrowPeak' in peak_fp or sli[5] in ('+', '-', '.')):
+                return 'narrowPeak', skip_rows
+            if len(sli) >= 4:
+                return 'bed4', skip_rows
+            return 'bed3', skip_rows
+    return None, skip_rows
+
+
+def read_peaks(peak_fp, peak_format=None):
+    """
+    一次读入整个peak文件，按染色体分组并按start, end排序后存为PeakTable。
+    列之间用制表符分隔，文件可以是gzip压缩的(.gz)。格式见detect_peaks_format，
+    bed4和narrowPeak中summit不是整数或者为负数的peak使用peak的中心作为summit
+    :param peak_fp: peak文件路径
+    :param peak_format: PEAK_FORMATS中的格式名，为None时自动识别
+    :return: PeakTable
+    """
+    import pandas as pd
+    detected, skip_rows = detect_peaks_format(peak_fp)
+    pks = PeakTable()
+    if detected is None:
+        return pks
+    summit_col, absolute = PEAK_FORMATS[peak_format or detected]
+    usecols = [0, 1, 2] if summit_col is None else [0, 1, 2, summit_col]
+    # 不用comment='#'：它会截断任何位置出现#的字段(比如peak名)。开头的注释行已经跳过，
+    # 中间以#开头的行会使start, end列不是整数，这时再去掉这些行。summit列的类型由pandas推断
+    table = pd.read_csv(
+        peak_fp, sep='\t', header=None, skiprows=skip_rows, usecols=usecols, dtype={0: str},
+        compression='gzip' if peak_fp.endswith('.gz') else None
+    )
+    if table[1].dtype != np.int64 or table[2].dtype != np.int64:
+        table = table[~table[0].str.startswith('#')]
+    starts, ends = np.asarray(table[1].values, dtype=np.int64), np.asarray(table[2].values, dtype=np.int64)
+    summits = (starts + ends) // 2 + 1
+    if summit_col is not None:
+        offsets = table[summit_col]
+        if offsets.dtype == object:
+            offsets = pd.to_numeric(offsets, errors='coerce')
+        offsets = offsets.values.astype(np.float64)
+        has_summit = np.isfinite(offsets)
+        if not absolute:
+            has_summit[has_summit] = offsets[has_summit] >= 0
+            offsets[has_summit] += starts[has_summit]
+        summits[has_summit] = offsets[has_summit]
+
+    # 只对不同的染色体名去掉首尾空白
+    codes, names = pd.factorize(table[0].values)
+    names = [name.strip() for name in names]
+    if len(set(names)) < len(names):
+        name_codes, names = pd.factorize(np.array(names, dtype=object))
+        codes = name_codes[codes]
+    order = np.lexsort((ends, starts, codes))
+    bounds = np.cumsum(np.bincount(codes, minlength=len(names)))[:-1]
+    for chrm, idx in zip(names, np.split(order, bounds)):
+        pks.add_chrm(chrm, starts[idx], ends[idx], summits[idx])
     return pks
 
 
-def read_peaks(peak_fp):
-    if peak_fp.endswith('.xls'):
-        return _read_macs_xls_peaks(peak_fp)
-    else:
-        return _read_peaks(peak_fp)
+# 输出时每次格式化并写入的行数
+_OUTPUT_CHUNK_SIZE = 1 << 16
+
+
+def _open_output(file_name, compress=False):
+    """
+    打开输出文件，compress为True时写gzip压缩文件，文件名后加.gz
+    """
+    if compress:
+        return gzip.open(file_name + '.gz', 'wb')
+    return open(file_name, 'w')
+
+
+def _format_column(values, fmt=None):
+    """
+    把一列值整体格式化为字符串列表，fmt为None时与str()相同
+    """
+    values = values.tolist() if isinstance(values, np.ndarray) else list(values)
+    if fmt is None:
+        return map(str, values)
+    return map(fmt.__mod__, values)
+
+
+def _write_rows(fo, columns, size):
+    """
+    按块把几列数据格式化成制表符分隔的行，每块只调用一次write
+    :param columns: [(数组或列表, 格式), ...]
+    :param size: 行数
+    """
+    for head in xrange(0, size, _OUTPUT_CHUNK_SIZE):
+        fields = [_format_column(values[head:head + _OUTPUT_CHUNK_SIZE], fmt) for values, fmt in columns]
+        fo.write(''.join(['\t'.join(row) + '\n' for row in zip(*fields)]))
+
 
+def _mavalues_header(rds1_name, rds2_name):
+    return '\t'.join(['chr', 'start', 'end', 'summit', 'M_value', 'A_value', 'P_value', 'Peak_Group',
+                      'normalized_read_density_in_%s' % rds1_name, 'normalized_read_density_in_%s\n' % rds2_name])
 
-def output_normalized_peaks(pks_unique, pks_common, file_name, rds1_name, rds2_name):
+
+def _write_mavalues_rows(fo, pks, group_name):
+    starts = pks.column('start')
+    _write_rows(fo, [
+        (pks.chrm_column(), None), (starts, '%d'), (pks.column('end'), '%d'), (pks.column('summit') - starts, '%d'),
+        (pks.column('normed_mvalue'), '%f'), (pks.column('normed_avalue'), '%f'), (pks.column('pvalue'), None),
+        ([group_name] * pks.size(), None),
+        (pks.column('normed_read_density1'), '%f'), (pks.column('read_density2'), '%f'),
+    ], pks.size())
+
+
+def output_normalized_peaks(pks_unique, pks_common, file_name, rds1_name, rds2_name, compress=False):
     """
     输出MAnorm标准化后的结果
     """
-    fo = open(file_name, 'w')
-    # declaration = manorm_file_declaration
-    header = '\t'.join(['chr', 'start', 'end', 'summit', 'M_value', 'A_value', 'P_value', 'Peak_Group',
-                        'normalized_read_density_in_%s' % rds1_name, 'normalized_read_density_in_%s\n' % rds2_name])
-    # fo.write(declaration)
-    fo.write(header)
-    for chrm in pks_unique.keys():
-        for pk in pks_unique[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), 'unique',
-                   pk.normed_read_density1, pk.read_density2,)
-            fo.write('\t'.join(['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    for chrm in pks_common.keys():
-        for pk in pks_common[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), 'common',
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    fo.close()
-
-
-def output_3set_normalized_peaks(pks1_unique, merged_pks, pks2_unique, file_name, pks1_name, pks2_name, rds1_name, rds2_name):
+    with _open_output(file_name, compress) as fo:
+        fo.write(_mavalues_header(rds1_name, rds2_name))
+        _write_mavalues_rows(fo, pks_unique, 'unique')
+        _write_mavalues_rows(fo, pks_common, 'common')
+
+
+def output_3set_normalized_peaks(pks1_unique, merged_pks, pks2_unique, file_name, pks1_name, pks2_name, rds1_name,
+                                 rds2_name, compress=False):
     """
     输出pks1_unique, pks2_unique, merged_pks所有的peaks
     """
-    fo = open(file_name, 'w')
-    # declaration = manorm_file_declaration
-    header = '\t'.join(['chr', 'start', 'end', 'summit', 'M_value', 'A_value', 'P_value', 'Peak_Group',
-                        'normalized_read_density_in_%s' % rds1_name, 'normalized_read_density_in_%s\n' % rds2_name])
-    # fo.write(declaration)
-    fo.write(header)
-    for chrm in pks1_unique.keys():
-        for pk in pks1_unique[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), '%s_unique' % pks1_name,
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    for chrm in merged_pks.keys():
-        for pk in merged_pks[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), 'merged_common_peak',
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    for chrm in pks2_unique.keys():
-        for pk in pks2_unique[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), '%s_unique' % pks2_name,
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    fo.close()
-
-
-def draw_figs_to_show_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name, ma_fit, reads1_name, reads2_name):
+    with _open_output(file_name, compress) as fo:
+        fo.write(_mavalues_header(rds1_name, rds2_name))
+        _write_mavalues_rows(fo, pks1_unique, '%s_unique' % pks1_name)
+        _write_mavalues_rows(fo, merged_pks, 'merged_common_peak')
+        _write_mavalues_rows(fo, pks2_unique, '%s_unique' % pks2_name)
+
+
+def output_mvalue_matrix(union_pks, sample_names, present, read_density, pair_names, mvalues, pvalues, file_name,
+                         compress=False):
+    """
+    多样本比较的结果矩阵：每个union peak一行，各样本是否有peak、read density，以及每对样本标准化后的M值和P值
+    :param present: (peaks数, 样本数)的布尔矩阵
+    :param read_density: (peaks数, 样本数)的read density矩阵
+    :param mvalues, pvalues: (peaks数, 样本对数)的矩阵，列与pair_names对应
+    """
+    starts = union_pks.column('start')
+    with _open_output(file_name, compress) as fo:
+        fo.write('\t'.join(['chr', 'start', 'end', 'summit'] + ['peak_in_%s' % name for name in sample_names] +
+                           ['read_density_in_%s' % name for name in sample_names] +
+                           [prefix + name for name in pair_names for prefix in ('M_value_', 'P_value_')]) + '\n')
+        columns = [(union_pks.chrm_column(), None), (starts, '%d'), (union_pks.column('end'), '%d'),
+                   (union_pks.column('summit') - starts, '%d')]
+        columns += [(present[:, k], '%d') for k in xrange(len(sample_names))]
+        columns += [(read_density[:, k], '%f') for k in xrange(len(sample_names))]
+        for k in xrange(len(pair_names)):
+            columns += [(mvalues[:, k], '%f'), (pvalues[:, k], None)]
+        _write_rows(fo, columns, union_pks.size())
+
+
+# 作图模式：none不作图，fast对点数很多的散点图随机抽样、用hexbin画密度，full画出所有的点
+FIGURE_MODES = ('none', 'fast', 'full')
+# fast模式下每个散点图每组最多画出的点数
+_FAST_FIGURE_POINTS = 20000
+# -log10(P值)的颜色上限
+_FIGURE_MAX_NEG_LOG10_P = 50
+
+
+def _sample_points(size, mode, rng):
+    """
+    fast模式下点数超过_FAST_FIGURE_POINTS时不放回随机抽样，否则画出所有的点
+    :return: 需要画出的点的下标(升序)，或者表示全部的slice
+    """
+    if mode != 'fast' or size <= _FAST_FIGURE_POINTS:
+        return slice(None)
+    return np.sort(rng.choice(size, _FAST_FIGURE_POINTS, replace=False))
+
+
+def _import_pyplot():
+    """
+    第一次作图时才导入matplotlib，没有其它地方导入过pyplot时使用不需要图形界面的Agg后端
+    """
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot
+    return pyplot
+
+
+def draw_figs_to_show_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name, ma_fit, reads1_name, reads2_name,
+                           mode='full', fig_dir='.'):
     """
     draw four figures to show data before and after rescaled
+    :param mode: 'fast'或'full'，fast模式下抽样作图并用hexbin画read density的散点图
+    :param fig_dir: 图片的输出目录
     """
+    plt = _import_pyplot()
     pks_3set = [pks1_uni, pks2_uni, merged_pks]
     pks1_name = ' '.join([pks1_name, 'unique'])
     pks2_name = ' '.join([pks2_name, 'unique'])
     merged_pks_name = 'merged common peaks'
     pks_names = [pks1_name, pks2_name, merged_pks_name]
     colors = 'bgr'
-    a_max = 0
-    a_min = 10000
-    plt.figure(1).set_size_inches(16, 12)
-    for (idx, pks) in enumerate(pks_3set):
+    # 所有需要的值只取一次，抽样固定随机种子，保证同样的输入画出同样的图
+    rng = np.random.RandomState(0)
+    values = []
+    for pks in pks_3set:
         mvalues, avalues = get_peaks_mavalues(pks)
-        if len(avalues) != 0:
-            a_max = max(max(avalues), a_max)
-            a_min = min(min(avalues), a_min)
-        plt.scatter(avalues, mvalues, s=10, c=colors[idx])
+        normed_mvalues, normed_avalues = get_peaks_normed_mavalues(pks)
+        neg_log10_pvalues = np.minimum(pks.column('neg_log10_pvalue'), _FIGURE_MAX_NEG_LOG10_P)
+        locs = _sample_points(mvalues.size, mode, rng)
+        values.append((mvalues[locs], avalues[locs], normed_mvalues[locs], normed_avalues[locs],
+                       neg_log10_pvalues[locs]))
+    all_avalues = np.concatenate([pks.column('avalue') for pks in pks_3set])
+    a_min = min(all_avalues.min(), 10000) if all_avalues.size > 0 else 10000
+    a_max = max(all_avalues.max(), 0) if all_avalues.size > 0 else 0
+
+    plt.figure(1).set_size_inches(16, 12)
+    for (idx, (mvalues, avalues, _, _, _)) in enumerate(values):
+        plt.scatter(avalues, mvalues, s=10, c=colors[idx], rasterized=True)
     plt.xlabel('A value')
     plt.ylabel('M value')
     plt.grid(axis='y')
@@ -218,153 +728,299 @@ def draw_figs_to_show_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name,
     x = np.arange(a_min, a_max, 0.01)
     y = ma_fit[1] * x + ma_fit[0]
     plt.plot(x, y, '-', color='k')
-    plt.savefig('before_rescale.png')
+    plt.savefig(os.path.join(fig_dir, 'before_rescale.png'))
 
     # plot the scatter plots of read count in merged common peaks between two chip-seq sets
     plt.figure(2).set_size_inches(16, 12)
-    rd_min = 1000
-    rd_max = 0
-    rds_density1, rds_density2 = [], []
-    for key in merged_pks.keys():
-        for pk in merged_pks[key]:
-            rds_density1.append(pk.read_density1), rds_density2.append(pk.read_density2)
-    rd_max = max(max(log2(rds_density1)), rd_max)
-    rd_min = min(min(log2(rds_density1)), rd_min)
-    plt.scatter(log2(rds_density1), log2(rds_density2), s=10, c='r', label=merged_pks_name, alpha=0.5)
+    with np.errstate(divide='ignore'):
+        log2_rds1 = np.log2(merged_pks.column('read_density1'))
+        log2_rds2 = np.log2(merged_pks.column('read_density2'))
+    finite = np.isfinite(log2_rds1) & np.isfinite(log2_rds2)
+    log2_rds1, log2_rds2 = log2_rds1[finite], log2_rds2[finite]
+    rd_min = min(log2_rds1.min(), 1000) if log2_rds1.size > 0 else 1000
+    rd_max = max(log2_rds1.max(), 0) if log2_rds1.size > 0 else 0
+    if mode == 'fast' and log2_rds1.size > 0:
+        plt.hexbin(log2_rds1, log2_rds2, gridsize=200, bins='log', mincnt=1, cmap='Reds')
+        plt.colorbar(label='log10(count) of ' + merged_pks_name)
+    else:
+        plt.scatter(log2_rds1, log2_rds2, s=10, c='r', label=merged_pks_name, alpha=0.5, rasterized=True)
+        plt.legend(loc='upper left')
     plt.xlabel(' log2 read density' + ' by ' + '"' + reads1_name + '" reads')
     plt.ylabel(' log2 read density' + ' by ' + '"' + reads2_name + '" reads')
     plt.grid(axis='y')
-    plt.legend(loc='upper left')
     plt.title('Fitting Model via common peaks')
     rx = np.arange(rd_min, rd_max, 0.01)
-    ry = (2 - ma_fit[1]) * rx / (2 + ma_fit[1]) - 2 * ma_fit[0] / (2 + ma_fit[1])
+    ry = rescale_log2_density(rx, ma_fit)
     plt.plot(rx, ry, '-', color='k')
-    plt.savefig('log2_read_density.png')
+    plt.savefig(os.path.join(fig_dir, 'log2_read_density.png'))
 
     # plot the MA plot after rescale
     plt.figure(3).set_size_inches(16, 12)
-    for (idx, pks) in enumerate(pks_3set):
-        normed_mvalues, normed_avalues = get_peaks_normed_mavalues(pks)
-        plt.scatter(normed_avalues, normed_mvalues, s=10, c=colors[idx])
+    for (idx, (_, _, normed_mvalues, normed_avalues, _)) in enumerate(values):
+        plt.scatter(normed_avalues, normed_mvalues, s=10, c=colors[idx], rasterized=True)
     plt.xlabel('A value')
     plt.ylabel('M value')
     plt.grid(axis='y')
     plt.legend(pks_names, loc='best')
     plt.title('after rescale')
-    plt.savefig('after_rescale.png')
+    plt.savefig(os.path.join(fig_dir, 'after_rescale.png'))
 
     # generate MA plot for this set of peaks together with p-value
     plt.figure(4).set_size_inches(16, 12)
-    for (idx, pks) in enumerate(pks_3set):
-        normed_mvalues, normed_avalues = get_peaks_normed_mavalues(pks)
-        colors = -log10(get_peaks_pvalues(pks))
-        for i, c in enumerate(colors):
-            if c > 50:
-                colors[i] = 50
-        plt.scatter(normed_avalues, normed_mvalues, s=10, c=colors, cmap='jet')
+    for (_, _, normed_mvalues, normed_avalues, neg_log10_pvalues) in values:
+        plt.scatter(normed_avalues, normed_mvalues, s=10, c=neg_log10_pvalues, cmap='jet', rasterized=True)
     plt.colorbar()
     plt.grid(axis='y')
     plt.xlabel('A value')
     plt.ylabel('M value')
     plt.title('-log10(P-value)')
-    plt.savefig('-log10_P-value.png')
-    plt.close()
+    plt.savefig(os.path.join(fig_dir, '-log10_P-value.png'))
+    plt.close('all')
+
 
+# 合并输出时三组peaks的来源
+_PKS1_UNIQUE, _MERGED, _PKS2_UNIQUE = 0, 1, 2
 
-def output_peaks_mvalue_2wig_file(pks1_uni, pks2_uni, merged_pks, comparison_name):
+
+def _iter_sorted_peaks(pks1_uni, pks2_uni, merged_pks):
     """
-    output of peaks with normed m value and p values
+    把三组peaks放在一起，按(染色体名, summit)只排序一次，然后逐条染色体返回
+    :return: 生成(chrm, {列名: 该染色体上按summit排序的数组})，'source'列是peak来自哪一组
     """
-    print 'output wig files ... '
-
-    peaks = _add_peaks(_add_peaks(pks1_uni, merged_pks), pks2_uni)
-    f_2write = open('_'.join([comparison_name, 'peaks_Mvalues.wig']), 'w')
-    f_2write.write('browser position chr11:5220000-5330000\n')
-    f_2write.write('track type=wiggle_0 name=%s' % comparison_name +
-                   ' visibility=full autoScale=on color=255,0,0 ' +
-                   ' yLineMark=0 yLineOnOff=on priority=10\n')
-    for chr_id in peaks.keys():
-        f_2write.write('variableStep chrom=' + chr_id + ' span=100\n')
-        pks_chr = peaks[chr_id]
-        sorted_pks_chr = _sort_peaks_list(pks_chr, 'summit')
-        # write sorted peak summit and m-value to file
-        [f_2write.write('\t'.join(['%d' % pk.summit, '%s\n' % str(pk.normed_mvalue)])) for pk in sorted_pks_chr]
-    f_2write.close()
-
-    f_2write = open('_'.join([comparison_name, 'peaks_Pvalues.wig']), 'w')
-    f_2write.write('browser position chr11:5220000-5330000\n')
-    f_2write.write('track type=wiggle_0 name=%s(-log10(p-value))' % comparison_name +
-                   ' visibility=full autoScale=on color=255,0,0 ' +
-                   ' yLineMark=0 yLineOnOff=on priority=10\n')
-    for chr_id in peaks.keys():
-        f_2write.write('variableStep chrom=' + chr_id + ' span=100\n')
-        pks_chr = peaks[chr_id]
-        sorted_pks_chr = _sort_peaks_list(pks_chr, 'summit')
-        # write sorted peak summit and m-value to file
-        [f_2write.write('\t'.join(['%d' % pk.summit, '%s\n' % str(-log10(pk.pvalue))])) for pk in sorted_pks_chr]
-    f_2write.close()
-
-
-def output_unbiased_peaks(pks1_uni, pks2_uni, merged_pks, unbiased_mvalue, overlap_dependent):
+    pks_sets = (pks1_uni, merged_pks, pks2_uni)
+    names = ('start', 'end', 'summit', 'normed_mvalue', 'pvalue', 'neg_log10_pvalue')
+    cols = {name: np.concatenate([pks.column(name) for pks in pks_sets]) for name in names}
+    cols['source'] = np.repeat([_PKS1_UNIQUE, _MERGED, _PKS2_UNIQUE], [pks.size() for pks in pks_sets])
+    chrm_names, chrm_codes = np.unique(np.concatenate([pks.chrm_column() for pks in pks_sets]), return_inverse=True)
+    order = np.lexsort((cols['summit'], chrm_codes))
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(chrm_codes, minlength=len(chrm_names)))))
+    for i, chrm in enumerate(chrm_names):
+        locs = order[bounds[i]:bounds[i + 1]]
+        yield chrm, {name: values[locs] for name, values in cols.items()}
+
+
+def _wig_header(track_name):
+    return 'browser position chr11:5220000-5330000\n' + \
+           'track type=wiggle_0 name=%s' % track_name + \
+           ' visibility=full autoScale=on color=255,0,0 ' + \
+           ' yLineMark=0 yLineOnOff=on priority=10\n'
+
+
+# track中每个summit覆盖的长度，以及支持的track格式
+_TRACK_SPAN = 100
+TRACK_FORMATS = ('wig', 'bedgraph', 'bigwig')
+
+
+def _write_wig_block(fo, chrm, summits, values):
+    fo.write('variableStep chrom=' + chrm + ' span=%d\n' % _TRACK_SPAN)
+    _write_rows(fo, [(summits, '%d'), (values, None)], summits.size)
+
+
+def _track_intervals(summits, chrm_size=None):
     """
-    输出没有显著差异的peak
+    把升序的summit(1-based)转成互不重叠的0-based半开区间：每个区间从summit开始覆盖_TRACK_SPAN，
+    遇到下一个summit时截断，同一位置的多个summit只保留第一个；
+    给出chrm_size时区间截断到染色体末端，start不在染色体内的summit去掉(bigWig不接受空区间)
+    :return: 保留的summit下标, starts, ends
     """
-    print 'define unbiased peaks: '
+    starts = summits - 1
+    locs = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    starts = starts[locs]
+    ends = starts + _TRACK_SPAN
+    ends[:-1] = np.minimum(ends[:-1], starts[1:])
+    if chrm_size is not None:
+        inside = starts < chrm_size
+        locs, starts, ends = locs[inside], starts[inside], np.minimum(ends[inside], chrm_size)
+    return locs, starts, ends
 
-    if not overlap_dependent:
-        pks = _add_peaks(_add_peaks(pks1_uni, merged_pks), pks2_uni)
-        name = 'all_peaks'
-    else:
-        pks = merged_pks
-        name = 'merged_common_peaks'
 
-    file_bed = open('unbiased_peaks_of_%s' % name + '.bed', 'w')
-    # file_bed.write(bed_peak_header)
-    i = 0
-    for key in pks.keys():
-        for pk in pks[key]:
-            if abs(pk.normed_mvalue) < unbiased_mvalue:
-                i += 1
-                line = '\t'.join([pk.chrm, '%d' % pk.start, '%d' % pk.end, 'from_%s_%d' % (name, i),
-                                  '%s\n' % str(pk.normed_mvalue)])
-                file_bed.write(line)
-    print 'filter %d unbiased peaks' % i
-    file_bed.close()
+def read_chrom_sizes(chrom_sizes_fp):
+    """
+    读取UCSC格式的chrom.sizes文件(染色体名\t长度)
+    :return: {chrm: 长度}
+    """
+    chrom_sizes = {}
+    with open(chrom_sizes_fp) as fi:
+        for li in fi:
+            sli = li.split()
+            if len(sli) >= 2 and not li.startswith('#'):
+                chrom_sizes[sli[0]] = int(sli[1])
+    return chrom_sizes
 
 
-def output_biased_peaks(pks1_uni, pks2_uni, merged_pks, biased_mvalue, biased_pvalue, overlap_dependent):
+class _TrackWriter(object):
     """
-    输出有显著差异的peaks
+    把每条染色体上按summit排序的值写成wig, bedGraph或bigWig格式的track。
+    bedGraph中的区间已排序且互不重叠，可以直接用bedGraphToBigWig转换；bigWig需要安装pyBigWig
     """
-    print 'define biased peaks:'
+    def __init__(self, file_prefix, track_name, track_format='wig', compress=False, chrom_sizes=None):
+        """
+        :param chrom_sizes: [(chrm, 长度), ...]，顺序与写入的染色体顺序一致，只有bigWig需要
+        """
+        self.track_format = track_format
+        self.chrom_sizes = dict(chrom_sizes) if chrom_sizes is not None else {}
+        if track_format == 'bigwig':
+            try:
+                import pyBigWig
+            except ImportError:
+                raise ImportError('writing bigWig tracks needs pyBigWig, please install it or use bedgraph tracks')
+            self.fo = pyBigWig.open(file_prefix + '.bw', 'w')
+            self.fo.addHeader(list(chrom_sizes))
+        elif track_format == 'bedgraph':
+            self.fo = _open_output(file_prefix + '.bedGraph', compress)
+        else:
+            self.fo = _open_output(file_prefix + '.wig', compress)
+            self.fo.write(_wig_header(track_name))
 
-    if not overlap_dependent:
-        pks = _add_peaks(_add_peaks(pks1_uni, merged_pks), pks2_uni)
-        name = 'all_peaks'
-    else:
-        pks = _add_peaks(pks1_uni, pks2_uni)
-        name = 'unique_peaks'
-
-    file_bed_over = open('M_over_%.2f_biased_peaks_of_%s' % (biased_mvalue, name) + '.bed', 'w')
-    # file_bed_over.write(bed_peak_header)
-    file_bed_less = open('M_less_-%.2f_biased_peaks_of_%s' % (biased_mvalue, name) + '.bed', 'w')
-    # file_bed_less.write(bed_peak_header)
-    i, j = 0, 0
-    for key in pks.keys():
-        for pk in pks[key]:
-            if pk.pvalue < biased_pvalue:
-                if pk.normed_mvalue > biased_mvalue:
-                    i += 1
-                    line = '\t'.join([pk.chrm, '%d' % pk.start, '%d' % pk.end, 'from_%s_%d' % (name, i),
-                                      '%s\n' % str(pk.normed_mvalue)])
-                    file_bed_over.write(line)
-                if pk.normed_mvalue < -biased_mvalue:
-                    j += 1
-                    line = '\t'.join([pk.chrm, '%d' % pk.start, '%d' % pk.end, 'from_%s_%d' % (name, j),
-                                      '%s\n' % str(pk.normed_mvalue)])
-                    file_bed_less.write(line)
-    print 'filter %d biased peaks' % (i + j)
-    file_bed_over.close(), file_bed_less.close()
+    def write_block(self, chrm, summits, values):
+        if self.track_format == 'wig':
+            _write_wig_block(self.fo, chrm, summits, values)
+            return
+        locs, starts, ends = _track_intervals(summits, self.chrom_sizes.get(chrm))
+        if self.track_format == 'bedgraph':
+            _write_rows(self.fo, [([chrm] * locs.size, None), (starts, '%d'), (ends, '%d'), (values[locs], None)],
+                        locs.size)
+        elif locs.size > 0:
+            self.fo.addEntries([chrm] * locs.size, starts.tolist(), ends=ends.tolist(), values=values[locs].tolist())
+
+    def close(self):
+        self.fo.close()
+
+
+def _track_chrom_sizes(pks_sets, chrom_sizes=None):
+    """
+    bigWig文件头中的染色体长度，按染色体名排序；没有给出长度的染色体用peaks覆盖到的最远位置代替
+    :param chrom_sizes: {chrm: 长度}
+    :return: [(chrm, 长度), ...]
+    """
+    sizes = {}
+    for pks in pks_sets:
+        for chrm in pks.keys():
+            cols = pks.columns(chrm)
+            if cols['start'].size > 0:
+                size = max(cols['end'].max(), cols['summit'].max() - 1 + _TRACK_SPAN)
+                sizes[chrm] = max(sizes.get(chrm, 0), int(size))
+    if chrom_sizes is not None:
+        sizes.update((chrm, chrom_sizes[chrm]) for chrm in sizes.keys() if chrm in chrom_sizes)
+    return sorted(sizes.items())
+
+
+def _write_bed_block(fo, chrm, cols, selected, name, count):
+    """
+    把一条染色体上被选中的peaks写成bed，peak名称按文件内的顺序编号
+    :return: 写入后文件内的peak总数
+    """
+    size = selected.sum()
+    _write_rows(fo, [
+        ([chrm] * size, None), (cols['start'][selected], '%d'), (cols['end'][selected], '%d'),
+        (np.arange(count + 1, count + size + 1), 'from_' + name + '_%d'), (cols['normed_mvalue'][selected], None),
+    ], size)
+    return count + size
+
+
+def _output_sorted_peaks(pks1_uni, pks2_uni, merged_pks, comparison_name=None, unbiased=None, biased=None,
+                         wig_dir='.', filter_dir='.', compress=False, track_format='wig', chrom_sizes=None):
+    """
+    在同一次遍历中写出M值、-log10(P值)的track文件和unbiased, biased peaks的bed文件，不需要的输出参数为None
+    :param comparison_name: track文件的名称前缀
+    :param unbiased: (unbiased_mvalue, overlap_dependent)
+    :param biased: (biased_mvalue, biased_pvalue, overlap_dependent)
+    :param track_format: 'wig', 'bedgraph'或'bigwig'
+    :param chrom_sizes: {chrm: 长度}，bigWig文件头使用
+    """
+    files = {}
+    if comparison_name is not None:
+        print 'output %s files ... ' % track_format
+        if track_format == 'bigwig':
+            chrom_sizes = _track_chrom_sizes((pks1_uni, merged_pks, pks2_uni), chrom_sizes)
+        files['mvalue'] = _TrackWriter(
+            os.path.join(wig_dir, '_'.join([comparison_name, 'peaks_Mvalues'])), comparison_name,
+            track_format, compress, chrom_sizes)
+        files['pvalue'] = _TrackWriter(
+            os.path.join(wig_dir, '_'.join([comparison_name, 'peaks_Pvalues'])),
+            '%s(-log10(p-value))' % comparison_name, track_format, compress, chrom_sizes)
+    if unbiased is not None:
+        print 'define unbiased peaks: '
+        unbiased_mvalue, unbiased_dependent = unbiased
+        unbiased_name = 'merged_common_peaks' if unbiased_dependent else 'all_peaks'
+        files['unbiased'] = _open_output(
+            os.path.join(filter_dir, 'unbiased_peaks_of_%s' % unbiased_name + '.bed'), compress)
+    if biased is not None:
+        print 'define biased peaks:'
+        biased_mvalue, biased_pvalue, biased_dependent = biased
+        biased_name = 'unique_peaks' if biased_dependent else 'all_peaks'
+        files['over'] = _open_output(
+            os.path.join(filter_dir, 'M_over_%.2f_biased_peaks_of_%s' % (biased_mvalue, biased_name) + '.bed'), compress)
+        files['less'] = _open_output(
+            os.path.join(filter_dir, 'M_less_-%.2f_biased_peaks_of_%s' % (biased_mvalue, biased_name) + '.bed'), compress)
+
+    counts = {'unbiased': 0, 'over': 0, 'less': 0}
+    try:
+        for chrm, cols in _iter_sorted_peaks(pks1_uni, pks2_uni, merged_pks):
+            mvalues = cols['normed_mvalue']
+            if comparison_name is not None:
+                files['mvalue'].write_block(chrm, cols['summit'], mvalues)
+                files['pvalue'].write_block(chrm, cols['summit'], cols['neg_log10_pvalue'])
+            if unbiased is not None:
+                selected = np.abs(mvalues) < unbiased_mvalue
+                if unbiased_dependent:
+                    selected &= cols['source'] == _MERGED
+                counts['unbiased'] = _write_bed_block(
+                    files['unbiased'], chrm, cols, selected, unbiased_name, counts['unbiased'])
+            if biased is not None:
+                selected = cols['pvalue'] < biased_pvalue
+                if biased_dependent:
+                    selected &= cols['source'] != _MERGED
+                counts['over'] = _write_bed_block(
+                    files['over'], chrm, cols, selected & (mvalues > biased_mvalue), biased_name, counts['over'])
+                counts['less'] = _write_bed_block(
+                    files['less'], chrm, cols, selected & (mvalues < -biased_mvalue), biased_name, counts['less'])
+    finally:
+        for fo in files.values():
+            fo.close()
+    if unbiased is not None:
+        print 'filter %d unbiased peaks' % counts['unbiased']
+    if biased is not None:
+        print 'filter %d biased peaks' % (counts['over'] + counts['less'])
+
+
+def output_peaks_tracks_and_filters(pks1_uni, pks2_uni, merged_pks, comparison_name, unbiased_mvalue, biased_mvalue,
+                                    biased_pvalue, overlap_dependent, wig_dir='.', filter_dir='.', compress=False,
+                                    track_format='wig', chrom_sizes=None):
+    """
+    所有peaks只排序一次，一次遍历写出track文件和unbiased, biased peaks的bed文件
+    """
+    _output_sorted_peaks(
+        pks1_uni, pks2_uni, merged_pks, comparison_name,
+        (unbiased_mvalue, overlap_dependent), (biased_mvalue, biased_pvalue, overlap_dependent),
+        wig_dir, filter_dir, compress, track_format, chrom_sizes
+    )
+
+
+def output_peaks_mvalue_2wig_file(pks1_uni, pks2_uni, merged_pks, comparison_name, compress=False,
+                                  track_format='wig', chrom_sizes=None):
+    """
+    output of peaks with normed m value and p values
+    """
+    _output_sorted_peaks(pks1_uni, pks2_uni, merged_pks, comparison_name, compress=compress,
+                         track_format=track_format, chrom_sizes=chrom_sizes)
+
+
+def output_unbiased_peaks(pks1_uni, pks2_uni, merged_pks, unbiased_mvalue, overlap_dependent, compress=False):
+    """
+    输出没有显著差异的peak
+    """
+    _output_sorted_peaks(pks1_uni, pks2_uni, merged_pks, unbiased=(unbiased_mvalue, overlap_dependent),
+                         compress=compress)
+
+
+def output_biased_peaks(pks1_uni, pks2_uni, merged_pks, biased_mvalue, biased_pvalue, overlap_dependent,
+                        compress=False):
+    """
+    输出有显著差异的peaks
+    """
+    _output_sorted_peaks(pks1_uni, pks2_uni, merged_pks, biased=(biased_mvalue, biased_pvalue, overlap_dependent),
+                         compress=compress)
 
 
 def test_read_reads():
@@ -373,7 +1029,7 @@ def test_read_reads():
 
 
 def test_read_peaks():
-    pks = _read_peaks('1_peaks')
+    pks = read_peaks('1_peaks')
     print pks.keys()
     print 'Done.'
 
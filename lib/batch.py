@@ -0,0 +1,148 @@
+# coding=utf-8
+# batch模式：按manifest依次比较多对样本，每个不同的peak文件和reads文件只读一次，
+# 读入的数据在进程池的子进程之间通过fork共享，每对样本输出到自己的目录
+import json
+import os
+
+from MAnorm_io import READS_CHUNK_MEMORY, read_peaks, read_reads_files
+from manorm import run_manorm, write_manorm_outputs, sample_name
+from parallel import map_shared
+from peaks import get_peaks_size
+from profiling import RunReport
+
+# manifest中每对样本的字段，shift1, shift2可以省略
+MANIFEST_FIELDS = ('name', 'peaks1', 'reads1', 'peaks2', 'reads2', 'shift1', 'shift2')
+_REQUIRED_FIELDS = MANIFEST_FIELDS[:5]
+_DEFAULT_SHIFT = 100
+
+
+def _check_pairs(pairs, manifest_fp):
+    names = set()
+    for i, pair in enumerate(pairs):
+        missing = [field for field in _REQUIRED_FIELDS if not pair.get(field)]
+        if missing:
+            raise ValueError('%s: pair %d misses %s' % (manifest_fp, i + 1, ', '.join(missing)))
+        if pair['name'] in names:
+            raise ValueError('%s: duplicated pair name "%s"' % (manifest_fp, pair['name']))
+        names.add(pair['name'])
+        pair['shift1'] = int(pair.get('shift1') or _DEFAULT_SHIFT)
+        pair['shift2'] = int(pair.get('shift2') or _DEFAULT_SHIFT)
+        # 相对路径都相对于manifest所在的目录
+        for field in ('peaks1', 'reads1', 'peaks2', 'reads2'):
+            pair[field] = os.path.join(os.path.dirname(os.path.abspath(manifest_fp)), pair[field])
+    return pairs
+
+
+def read_manifest(manifest_fp):
+    """
+    读取batch模式的manifest，支持两种格式：
+    1. 制表符分隔的文本，每行一对样本：name, peaks1, reads1, peaks2, reads2[, shift1, shift2]，
+       以#开头的行和以name开头的表头会跳过
+    2. .json文件，内容是由上述字段组成的对象的列表，或者{"pairs": [...]}
+    文件路径可以是相对于manifest所在目录的相对路径
+    :return: [{字段: 值}, ...]
+    """
+    if manifest_fp.endswith('.json'):
+        with open(manifest_fp) as fi:
+            pairs = json.load(fi)
+        if isinstance(pairs, dict):
+            pairs = pairs['pairs']
+        pairs = [{field: pair.get(field) for field in MANIFEST_FIELDS} for pair in pairs]
+    else:
+        pairs = []
+        with open(manifest_fp) as fi:
+            for li in fi:
+                sli = [x.strip() for x in li.rstrip('\r\n').split('\t')]
+                if not li.strip() or li.startswith('#') or sli[0] == 'name':
+                    continue
+                pairs.append(dict(zip(MANIFEST_FIELDS, sli)))
+    return _check_pairs(pairs, manifest_fp)
+
+
+def load_batch_inputs(pairs, chunk_memory=READS_CHUNK_MEMORY, use_index=False, index_dir=None, processes=1,
+                      stream=False, bam_options=None):
+    """
+    每个不同的peak文件和(reads文件, shift)只读一次
+    :param stream: 流式模式下不预先读入reads，每对样本计算时再逐条染色体读取
+    :return: {peak文件: PeakTable}, {(reads文件, shift): {chrm: 位点数组}或流式模式下的reads文件路径}
+    """
+    peaks_fps = sorted(set(pair[field] for pair in pairs for field in ('peaks1', 'peaks2')))
+    reads_keys = sorted(set((pair['reads%d' % i], pair['shift%d' % i]) for pair in pairs for i in (1, 2)))
+    peaks_cache = {peaks_fp: read_peaks(peaks_fp) for peaks_fp in peaks_fps}
+    if stream:
+        return peaks_cache, {key: key[0] for key in reads_keys}
+    positions = read_reads_files(reads_keys, chunk_memory, use_index, index_dir, processes, bam_options)
+    return peaks_cache, dict(zip(reads_keys, positions))
+
+
+def _run_pair(idx, shared):
+    """
+    在进程池中比较一对样本并输出结果，出错时返回错误信息而不影响其它样本
+    """
+    pairs, peaks_cache, reads_cache, output_root, run_params, output_params, processes = shared
+    pair = pairs[idx]
+    summary = {'name': pair['name'], 'status': 'ok', 'error': ''}
+    try:
+        report = RunReport()
+        report.info.update({'pair': pair})
+        result = run_manorm(
+            peaks_cache[pair['peaks1']], peaks_cache[pair['peaks2']],
+            reads_cache[(pair['reads1'], pair['shift1'])], reads_cache[(pair['reads2'], pair['shift2'])],
+            pair['shift1'], pair['shift2'], processes=processes, report=report,
+            names=tuple(sample_name(pair[field], field) for field in ('peaks1', 'peaks2', 'reads1', 'reads2')),
+            **run_params
+        )
+        output_dir = os.path.join(output_root, pair['name'])
+        write_manorm_outputs(result, output_dir, pair['name'], **output_params)
+        report.write(os.path.join(output_dir, 'run_report.json'))
+        summary.update({
+            'unique1': get_peaks_size(result.pks1_unique), 'common1': get_peaks_size(result.pks1_common),
+            'unique2': get_peaks_size(result.pks2_unique), 'common2': get_peaks_size(result.pks2_common),
+            'merged': get_peaks_size(result.merged_pks), 'slope': result.ma_fit[1], 'intercept': result.ma_fit[0],
+            'overlap_pvalue': result.overlap_pvalue, 'fit_iterations': result.fit_info['iterations'],
+            'fit_converged': result.fit_info['converged'], 'wall_time': report.wall_time(),
+        })
+    except Exception as e:
+        summary.update({'status': 'failed', 'error': '%s: %s' % (type(e).__name__, e)})
+    return summary
+
+
+_SUMMARY_FIELDS = ('name', 'status', 'unique1', 'common1', 'unique2', 'common2', 'merged', 'slope', 'intercept',
+                   'overlap_pvalue', 'fit_iterations', 'fit_converged', 'wall_time', 'error')
+
+
+def write_batch_summary(summaries, summary_fp):
+    with open(summary_fp, 'w') as fo:
+        fo.write('\t'.join(_SUMMARY_FIELDS) + '\n')
+        for summary in summaries:
+            fo.write('\t'.join(str(summary.get(field, '')) for field in _SUMMARY_FIELDS) + '\n')
+
+
+def run_batch(pairs, output_root, processes=1, chunk_memory=READS_CHUNK_MEMORY, use_index=False, index_dir=None,
+              run_params=None, output_params=None):
+    """
+    比较manifest中的每对样本，结果输出到output_root/<name>/，并写出output_root/batch_summary.xls
+    有多对样本时进程池按样本对并行，每对样本在一个进程内计算；只有一对时按染色体并行
+    :param pairs: read_manifest的结果
+    :param run_params: 传给run_manorm的参数(ext, min_smt_dist, random_time, seed, stream, bam_options,
+                       fit_max_points)
+    :param output_params: 传给write_manorm_outputs的参数
+    :return: 与pairs顺序一致的每对样本的结果摘要
+    """
+    run_params = dict(run_params or {})
+    output_params = dict(output_params or {})
+    for pair in pairs:
+        if os.path.exists(os.path.join(output_root, pair['name'])):
+            raise ValueError('output folder "%s" already exists' % os.path.join(output_root, pair['name']))
+    if not os.path.isdir(output_root):
+        os.makedirs(output_root)
+    peaks_cache, reads_cache = load_batch_inputs(pairs, chunk_memory, use_index, index_dir, processes,
+                                                 run_params.get('stream', False), run_params.get('bam_options'))
+    run_params.update({'chunk_memory': chunk_memory, 'use_index': use_index, 'index_dir': index_dir})
+    pair_processes = processes if len(pairs) > 1 else 1
+    inner_processes = 1 if pair_processes > 1 else processes
+    shared = (pairs, peaks_cache, reads_cache, output_root, run_params, output_params, inner_processes)
+    results = map_shared(_run_pair, range(len(pairs)), shared, pair_processes)
+    summaries = [results[i] for i in xrange(len(pairs))]
+    write_batch_summary(summaries, os.path.join(output_root, 'batch_summary.xls'))
+    return summaries
@@ -0,0 +1,157 @@
+# coding=utf-8
+# 保存和恢复MAnorm各步骤的中间结果：每个步骤一个.npz文件，里面记录由输入和参数算出的键，
+# 输入或参数变化后键不同，这个步骤和依赖它的后续步骤就会重新计算
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from MAnorm_io import AlignmentOptions, is_alignment_file
+from peaks import PeakTable
+
+# 检查点格式变化时增加版本号，使旧的检查点失效
+_CHECKPOINT_VERSION = 1
+CHECKPOINT_STAGES = ('classify', 'permutation', 'merge', 'density', 'fit')
+
+
+def _hash(*parts):
+    return hashlib.md5(json.dumps([_CHECKPOINT_VERSION] + list(parts), sort_keys=True)).hexdigest()
+
+
+def _hash_arrays(md5, arrays):
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        md5.update(str(arr.dtype))
+        md5.update(arr.tostring())
+
+
+def input_fingerprint(obj):
+    """
+    输入的标识：文件用绝对路径、修改时间和大小(与reads索引相同)，PeakTable和{chrm: reads位点数组}用内容的hash
+    """
+    if isinstance(obj, basestring):
+        stat = os.stat(obj)
+        return [os.path.abspath(obj), stat.st_mtime, stat.st_size]
+    md5 = hashlib.md5()
+    if isinstance(obj, PeakTable):
+        for chrm in sorted(obj.keys()):
+            md5.update(chrm)
+            cols = obj.columns(chrm)
+            _hash_arrays(md5, [cols['start'], cols['end'], cols['summit']])
+    else:
+        for chrm in sorted(obj.keys()):
+            md5.update(chrm)
+            _hash_arrays(md5, [np.asarray(obj[chrm])])
+    return md5.hexdigest()
+
+
+def _reads_fingerprint(reads, shift, bam_options):
+    tag = ''
+    if isinstance(reads, basestring) and is_alignment_file(reads):
+        tag = (bam_options or AlignmentOptions()).index_tag()
+    # 已经读入的reads位点不需要平移
+    return [input_fingerprint(reads), shift if isinstance(reads, basestring) else None, tag]
+
+
+def stage_keys(pks1, pks2, reads1, reads2, shift1, shift2, ext, min_smt_dist, random_time, seed,
+               bam_options=None, fit_max_points=None):
+    """
+    每个步骤的键，后面步骤的键包含它所依赖的步骤的键：
+    classify(peaks) -> permutation(+次数, 随机种子), merge -> density(+reads, 平移量, 延伸长度) -> fit(+summit距离)
+    :param pks1, pks2: PeakTable，各种形式的peaks输入都先用as_peak_table转换，再按内容计算标识
+    :param reads1, reads2: reads文件路径或者{chrm: reads位点数组}
+    :return: {步骤名: 键}
+    """
+    classify = _hash('classify', input_fingerprint(pks1), input_fingerprint(pks2))
+    merge = _hash('merge', classify)
+    density = _hash('density', merge, _reads_fingerprint(reads1, shift1, bam_options),
+                    _reads_fingerprint(reads2, shift2, bam_options), ext)
+    return {
+        'classify': classify,
+        'permutation': _hash('permutation', classify, random_time, seed),
+        'merge': merge,
+        'density': density,
+        'fit': _hash('fit', density, min_smt_dist, fit_max_points),
+    }
+
+
+def table_arrays(prefix, pks, names=('start', 'end', 'summit', 'group')):
+    """
+    把PeakTable的几列按染色体首尾相连成数组，用来保存到.npz文件
+    """
+    chrms = list(pks.keys())
+    arrays = {prefix + 'chrms': np.array(chrms, dtype=str),
+              prefix + 'sizes': np.array([pks.chrm_size(chrm) for chrm in chrms], dtype=np.int64)}
+    for name in names:
+        arrays[prefix + name] = pks.column(name)
+    return arrays
+
+
+def _iter_chrm_slices(arrays, prefix):
+    offsets = np.concatenate(([0], np.cumsum(arrays[prefix + 'sizes'])))
+    for i, chrm in enumerate(arrays[prefix + 'chrms'].tolist()):
+        yield chrm, slice(offsets[i], offsets[i + 1])
+
+
+def table_from_arrays(arrays, prefix):
+    """
+    由table_arrays保存的数组恢复PeakTable(只有start, end, summit和group)
+    """
+    pks = PeakTable()
+    for chrm, part in _iter_chrm_slices(arrays, prefix):
+        pks.add_chrm(chrm, arrays[prefix + 'start'][part], arrays[prefix + 'end'][part],
+                     arrays[prefix + 'summit'][part], arrays[prefix + 'group'][part])
+    return pks
+
+
+def chrm_arrays_from(arrays, prefix, name):
+    """
+    :return: {chrm: 数组}，按table_arrays保存的染色体顺序切分名为prefix + name的数组
+    """
+    return {chrm: arrays[prefix + name][part] for chrm, part in _iter_chrm_slices(arrays, prefix)}
+
+
+class Checkpoints(object):
+    """
+    folder中每个步骤的检查点<步骤名>.npz，只有文件中的键与当前的键相同时才会被读取。
+    folder为None时不读也不写检查点
+    """
+    def __init__(self, folder=None, keys=None):
+        self.folder = folder
+        self.keys = keys or {}
+
+    def enabled(self):
+        return self.folder is not None
+
+    def _path(self, stage):
+        return os.path.join(self.folder, stage + '.npz')
+
+    def load(self, stage):
+        """
+        :return: {名称: 数组}，检查点不存在或者键不同时返回None
+        """
+        if self.folder is None:
+            return None
+        try:
+            with np.load(self._path(stage)) as data:
+                if data['key'].item() != self.keys[stage]:
+                    return None
+                return {name: data[name] for name in data.files}
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def save(self, stage, arrays):
+        """
+        先写临时文件再改名，中断的运行不会留下写了一半的检查点
+        """
+        if self.folder is None:
+            return
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        arrays = dict(arrays)
+        arrays['key'] = np.array(self.keys[stage])
+        tmp_fp = '%s.tmp%d' % (self._path(stage), os.getpid())
+        with open(tmp_fp, 'wb') as fo:
+            np.savez(fo, **arrays)
+        os.rename(tmp_fp, self._path(stage))
@@ -0,0 +1,594 @@
+# coding=utf-8
+# MAnorm的Python接口：在内存中完成两组样本的比较，不改变工作目录，除了可选的检查点外也不写文件；
+# 需要时再用write_manorm_outputs把结果写到明确给出的目录中
+import json
+import os
+import shutil
+
+from checkpoint import CHECKPOINT_STAGES, Checkpoints, stage_keys, table_arrays, table_from_arrays, \
+    chrm_arrays_from
+from MAnorm_io import READS_CHUNK_MEMORY, read_peaks, read_reads_files, iter_reads_by_chrm, \
+    output_normalized_peaks, output_3set_normalized_peaks, output_peaks_tracks_and_filters, draw_figs_to_show_data
+from parallel import map_shared, start_background, join_background
+from peaks import Peak, PeakTable, ReadsCoverage, get_peaks_size, get_common_peaks, permutation_overlap_test, \
+    merge_common_peaks, count_window_reads, cal_peaks_read_density, cal_peaks_read_density_sweep, \
+    init_peaks_read_counts, cal_peaks_read_density_from_counts, select_fit_peaks, use_merged_peaks_fit_model, \
+    format_ma_model, normalize_peaks
+from profiling import RunReport
+
+import numpy as np
+
+
+class MAnormResult(object):
+    """
+    run_manorm的结果
+    pks1_unique, pks1_common, pks2_unique, pks2_common: 两组peaks按是否重叠分组后的PeakTable
+    merged_pks: 合并后的common peaks; summit_dist: {chrm: 合并前两个summit之间的距离}
+    ma_fit: 标准化模型的(截距, 斜率)，M = ma_fit[1] * A + ma_fit[0]
+    fit_info: 拟合的迭代次数、是否收敛、参与拟合的点数等，见huber_line_fit
+    fold_changes, overlap_pvalue: 随机重排检验的倍数和经验p值
+    report: 各步骤耗时和数据量的RunReport
+    """
+    def __init__(self, **kwargs):
+        self.pks1_name = kwargs.pop('pks1_name')
+        self.pks2_name = kwargs.pop('pks2_name')
+        self.reads1_name = kwargs.pop('reads1_name')
+        self.reads2_name = kwargs.pop('reads2_name')
+        self.pks1_unique = kwargs.pop('pks1_unique')
+        self.pks1_common = kwargs.pop('pks1_common')
+        self.pks2_unique = kwargs.pop('pks2_unique')
+        self.pks2_common = kwargs.pop('pks2_common')
+        self.merged_pks = kwargs.pop('merged_pks')
+        self.summit_dist = kwargs.pop('summit_dist')
+        self.ma_fit = kwargs.pop('ma_fit')
+        self.fit_info = kwargs.pop('fit_info', None)
+        self.fold_changes = kwargs.pop('fold_changes')
+        self.overlap_pvalue = kwargs.pop('overlap_pvalue')
+        self.params = kwargs.pop('params')
+        self.report = kwargs.pop('report')
+
+    def peak_tables(self):
+        """
+        :return: 参与计算的5组peaks
+        """
+        return self.pks1_unique, self.pks1_common, self.pks2_unique, self.pks2_common, self.merged_pks
+
+    def peaks_size(self):
+        return sum(get_peaks_size(pks) for pks in self.peak_tables())
+
+
+def sample_name(obj, default):
+    """
+    输入是文件路径时用去掉扩展名的文件名作为样本名，否则用默认名
+    """
+    if isinstance(obj, basestring):
+        return os.path.basename(obj).split('.')[0].replace(' ', '_')
+    return default
+
+
+def _is_peak_list(values):
+    return isinstance(values, list) and all(isinstance(pk, Peak) for pk in values)
+
+
+def as_peak_table(peaks):
+    """
+    :param peaks: PeakTable, peak文件路径, Peak的列表, {chrm: [Peak, ...]},
+                  或者{chrm: (starts, ends)或(starts, ends, summits)}
+    :return: PeakTable
+    """
+    if isinstance(peaks, PeakTable):
+        return peaks
+    if isinstance(peaks, basestring):
+        return read_peaks(peaks)
+    if not isinstance(peaks, dict):
+        # Peak的列表先按染色体分组
+        chrm_peaks = {}
+        for pk in peaks:
+            chrm_peaks.setdefault(pk.chrm, []).append(pk)
+        peaks = chrm_peaks
+    table = PeakTable()
+    for chrm in sorted(peaks.keys()):
+        if _is_peak_list(peaks[chrm]):
+            table.set_columns(chrm, PeakTable.from_peaks({chrm: peaks[chrm]}).columns(chrm))
+        else:
+            table.add_chrm(chrm, *peaks[chrm])
+    return table
+
+
+def _as_reads_position(position):
+    """
+    :param position: {chrm: reads位点数组}，没有排序的数组会先排序
+    :return: {chrm: 升序的numpy数组}
+    """
+    sorted_position = {}
+    for chrm, pos in position.items():
+        pos = np.asarray(pos)
+        if pos.size > 1 and np.any(pos[1:] < pos[:-1]):
+            pos = np.sort(pos)
+        sorted_position[chrm] = pos
+    return sorted_position
+
+
+def load_reads_positions(reads1, reads2, shift1=100, shift2=100, chunk_memory=READS_CHUNK_MEMORY, use_index=False,
+                         index_dir=None, processes=1, bam_options=None):
+    """
+    :param reads1, reads2: bed或BAM/SAM格式的reads文件路径，或者已经读入的{chrm: reads位点数组}
+    :param bam_options: 读取BAM/SAM文件时的AlignmentOptions
+    :return: 两组reads的{chrm: 升序的位点数组}
+    """
+    files = [(reads, shift) for reads, shift in ((reads1, shift1), (reads2, shift2)) if isinstance(reads, basestring)]
+    loaded = iter(read_reads_files(files, chunk_memory, use_index, index_dir, processes, bam_options) if files else [])
+    return [next(loaded) if isinstance(reads, basestring) else _as_reads_position(reads) for reads in (reads1, reads2)]
+
+
+def _stream_sample_counts(sample, shared):
+    """
+    逐条染色体读取一个样本的reads，只累加每个peak的read数，每条染色体的位点用完即释放
+    :return: 每组peaks的{chrm: read数数组}, reads总数
+    """
+    pks_sets, reads_list, ext, chunk_memory, use_index, index_dir, bam_options = shared
+    reads, shift = reads_list[sample - 1]
+    if isinstance(reads, basestring):
+        chrm_iter = iter_reads_by_chrm(reads, shift, chunk_memory, use_index, index_dir, bam_options)
+    else:
+        chrm_iter = sorted(_as_reads_position(reads).items())
+    # 在peaks的副本上累加，子进程中计算时只需要把read数传回父进程
+    counts = [{chrm: np.zeros(pks.chrm_size(chrm), dtype=np.int64) for chrm in pks.keys()} for pks in pks_sets]
+    reads_num = 0
+    for chrm, chrm_pos in chrm_iter:
+        reads_num += chrm_pos.size
+        for pks, pks_counts in zip(pks_sets, counts):
+            if chrm in pks_counts:
+                pks_counts[chrm] += count_window_reads(pks.columns(chrm)['summit'], [chrm_pos], ext)[0]
+    return counts, reads_num
+
+
+def stream_peaks_read_density(pks_sets, reads1, reads2, shift1, shift2, ext, chunk_memory=READS_CHUNK_MEMORY,
+                              use_index=False, index_dir=None, processes=1, bam_options=None):
+    """
+    流式计算read density：两个样本的reads分别逐条染色体读取(processes > 1时两个样本同时读)，
+    内存中最多只有每个样本一条染色体的reads位点，不需要先读入整个reads文件
+    :param pks_sets: 需要计算的PeakTable列表
+    :param reads1, reads2: 按染色体排序的reads文件路径(或者有索引)，也可以是{chrm: 位点数组}
+    :return: 两个样本的reads总数
+    """
+    shared = (pks_sets, [(reads1, shift1), (reads2, shift2)], ext, chunk_memory, use_index, index_dir, bam_options)
+    sample_counts = map_shared(_stream_sample_counts, (1, 2), shared, min(processes, 2))
+    for pks in pks_sets:
+        init_peaks_read_counts(pks)
+    for sample in (1, 2):
+        counts, _ = sample_counts[sample]
+        for pks, pks_counts in zip(pks_sets, counts):
+            for chrm, chrm_counts in pks_counts.items():
+                pks.columns(chrm)['read_count%d' % sample] += chrm_counts
+    for pks in pks_sets:
+        cal_peaks_read_density_from_counts(pks, ext)
+    return sample_counts[1][1], sample_counts[2][1]
+
+
+def run_manorm(peaks1, peaks2, reads1, reads2, shift1=100, shift2=100, ext=1000, min_smt_dist=None, random_time=5,
+               seed=None, processes=1, chunk_memory=READS_CHUNK_MEMORY, use_index=False, index_dir=None, names=None,
+               verbose=False, report=None, stream=False, bam_options=None, fit_max_points=None, checkpoint_dir=None):
+    """
+    对两组样本做MAnorm标准化和比较，所有计算都在内存中完成，输入不会被修改
+    :param peaks1, peaks2: PeakTable, peak文件路径, Peak的列表, 或者{chrm: (starts, ends[, summits])}
+    :param reads1, reads2: bed或BAM/SAM格式的reads文件路径，或者{chrm: reads位点数组}(已经平移过)
+    :param shift1, shift2: 从文件读入reads时的平移量
+    :param ext: 计算read density时summit两侧的延伸长度
+    :param min_smt_dist: 用于拟合模型的merged common peaks的summit距离上限，默认为ext / 2
+    :param random_time: 随机重排检验的次数
+    :param seed: 随机重排的随机种子
+    :param processes: 按染色体(以及按文件)并行的进程数
+    :param names: (pks1_name, pks2_name, reads1_name, reads2_name)，默认从文件名得到
+    :param verbose: 是否打印每一步的信息
+    :param report: 记录各步骤耗时的RunReport，默认新建一个
+    :param stream: 流式模式，不预先读入reads，计算read density时逐条染色体读取按染色体排序的reads文件，
+                   内存上限由最大的染色体决定
+    :param bam_options: 读取BAM/SAM文件时的AlignmentOptions(比对质量、duplicate过滤和解压线程数)
+    :param fit_max_points: 用于拟合模型的peaks超过这个数量时按固定的随机种子抽样拟合
+    :param checkpoint_dir: 保存各步骤检查点的目录。输入和参数都没有变化的步骤直接从检查点恢复，
+                           比如只改变输出的阈值时不需要再读reads、分组、合并、计算read density和拟合
+    :return: MAnormResult
+    """
+    if min_smt_dist is None:
+        min_smt_dist = ext / 2
+    names, report, log = _run_context(peaks1, peaks2, reads1, reads2, names, verbose, report)
+    log('Reading Data, please wait for a while...')
+    pks1, pks2 = _read_peak_inputs(peaks1, peaks2, report)
+    checkpoints = Checkpoints()
+    if checkpoint_dir is not None:
+        checkpoints = Checkpoints(checkpoint_dir, stage_keys(
+            pks1, pks2, reads1, reads2, shift1, shift2, ext, min_smt_dist, random_time, seed, bam_options,
+            fit_max_points))
+    saved = {stage: checkpoints.load(stage) for stage in CHECKPOINT_STAGES}
+    # read数已保存时不需要读reads
+    reads_pos1, reads_pos2 = None, None
+    if saved['density'] is None and not stream:
+        reads_pos1, reads_pos2 = _read_reads_inputs(
+            reads1, reads2, shift1, shift2, chunk_memory, use_index, index_dir, processes, report, bam_options)
+    pks_5set, summit_dist, fcs, overlap_pvalue = _classify_and_merge(
+        pks1, pks2, names, random_time, seed, processes, report, log, checkpoints, saved)
+    pks_num = sum(get_peaks_size(pks) for pks in pks_5set)
+
+    log('Step4: Calculating peaks read density')
+    with report.stage('density', peaks=pks_num, stream=stream):
+        reads_num = _restore_read_counts(pks_5set, saved['density'], ext)
+        if reads_num is not None:
+            reads_num1, reads_num2 = reads_num
+            log('read counts restored from the checkpoint')
+        elif stream:
+            reads_num1, reads_num2 = stream_peaks_read_density(
+                pks_5set, reads1, reads2, shift1, shift2, ext, chunk_memory, use_index, index_dir, processes,
+                bam_options)
+        else:
+            if reads_pos1 is None:
+                # 检查点与peaks不一致时才会发生
+                reads_pos1, reads_pos2 = load_reads_positions(
+                    reads1, reads2, shift1, shift2, chunk_memory, use_index, index_dir, processes, bam_options)
+            reads_num1, reads_num2 = _reads_num(reads_pos1), _reads_num(reads_pos2)
+            for pks in pks_5set:
+                cal_peaks_read_density(pks, reads_pos1, reads_pos2, ext, processes)
+        if reads_num is None:
+            checkpoints.save('density', _read_counts_arrays(pks_5set, reads_num1, reads_num2))
+    report.add_counts('density', reads1=reads_num1, reads2=reads_num2, restored=reads_num is not None)
+
+    ma_fit, fit_info = _fit_and_normalize(pks_5set, summit_dist, min_smt_dist, report, log, fit_max_points,
+                                          checkpoints, saved['fit'])
+    params = {'shift1': shift1, 'shift2': shift2, 'ext': ext, 'min_smt_dist': min_smt_dist,
+              'random_time': random_time, 'seed': seed, 'stream': stream, 'fit_max_points': fit_max_points}
+    return _make_result(names, pks_5set, summit_dist, ma_fit, fit_info, fcs, overlap_pvalue, params, report)
+
+
+def _run_context(peaks1, peaks2, reads1, reads2, names, verbose, report):
+    """
+    :return: 样本名, RunReport, 打印信息的函数
+    """
+    if names is None:
+        names = (sample_name(peaks1, 'peaks1'), sample_name(peaks2, 'peaks2'),
+                 sample_name(reads1, 'reads1'), sample_name(reads2, 'reads2'))
+    report = report if report is not None else RunReport()
+
+    def log(msg):
+        if verbose:
+            print msg
+    return names, report, log
+
+
+def _reads_num(reads_pos):
+    return sum(pos.size for pos in reads_pos.values())
+
+
+def _read_peak_inputs(peaks1, peaks2, report):
+    """
+    :return: 两组PeakTable
+    """
+    with report.stage('read_peaks'):
+        pks1, pks2 = as_peak_table(peaks1), as_peak_table(peaks2)
+    report.add_counts('read_peaks', peaks1=get_peaks_size(pks1), peaks2=get_peaks_size(pks2))
+    return pks1, pks2
+
+
+def _read_reads_inputs(reads1, reads2, shift1, shift2, chunk_memory, use_index, index_dir, processes, report,
+                       bam_options=None):
+    """
+    :return: 两组reads的{chrm: 升序的位点数组}
+    """
+    with report.stage('read'):
+        reads_pos1, reads_pos2 = load_reads_positions(
+            reads1, reads2, shift1, shift2, chunk_memory, use_index, index_dir, processes, bam_options)
+    report.add_counts('read', reads1=_reads_num(reads_pos1), reads2=_reads_num(reads_pos2))
+    return reads_pos1, reads_pos2
+
+
+def _classify_and_merge(pks1, pks2, names, random_time, seed, processes, report, log, checkpoints=None, saved=None):
+    """
+    Step1 - Step3: 按是否重叠分组、随机重排检验、合并common peaks
+    :param checkpoints: Checkpoints，每一步的结果都会保存
+    :param saved: {步骤名: 检查点中的数组}，有的步骤直接从中恢复
+    :return: (pks1_unique, pks1_common, pks2_unique, pks2_common, merged_pks), summit_dist, 倍数, 经验p值
+    """
+    checkpoints = checkpoints if checkpoints is not None else Checkpoints()
+    saved = saved or {}
+    pks1_name, pks2_name = names[:2]
+    log('Step1: Classify the 2 peaks by overlap')
+    with report.stage('overlap'):
+        if saved.get('classify') is not None:
+            pks1_uniq, pks1_com, pks2_uniq, pks2_com = [table_from_arrays(saved['classify'], '%d_' % i)
+                                                        for i in xrange(4)]
+        else:
+            pks1_uniq, pks1_com, pks2_uniq, pks2_com = get_common_peaks(pks1, pks2, processes)
+            arrays = {}
+            for i, pks in enumerate((pks1_uniq, pks1_com, pks2_uniq, pks2_com)):
+                arrays.update(table_arrays('%d_' % i, pks))
+            checkpoints.save('classify', arrays)
+    peaks_num1 = get_peaks_size(pks1_uniq) + get_peaks_size(pks1_com)
+    peaks_num2 = get_peaks_size(pks2_uniq) + get_peaks_size(pks2_com)
+    report.add_counts('overlap', peaks1=peaks_num1, peaks2=peaks_num2,
+                      unique1=get_peaks_size(pks1_uniq), common1=get_peaks_size(pks1_com),
+                      unique2=get_peaks_size(pks2_uniq), common2=get_peaks_size(pks2_com),
+                      restored=saved.get('classify') is not None)
+    log('%s: %d(unique) %d(common)\n%s: %d(unique) %d(common)' % (
+        pks1_name, get_peaks_size(pks1_uniq), get_peaks_size(pks1_com),
+        pks2_name, get_peaks_size(pks2_uniq), get_peaks_size(pks2_com)))
+
+    log('Step2: Random overlap testing, test time is %d' % random_time)
+    with report.stage('permutation', peaks1=peaks_num1, peaks2=peaks_num2, random_time=random_time,
+                      restored=saved.get('permutation') is not None):
+        if saved.get('permutation') is not None:
+            fcs, overlap_pvalue = saved['permutation']['fold_changes'], saved['permutation']['pvalue'].item()
+        else:
+            fcs, overlap_pvalue = permutation_overlap_test(pks1, pks2, random_time, seed)
+            checkpoints.save('permutation', {'fold_changes': fcs, 'pvalue': np.array(overlap_pvalue)})
+    log('fold change: mean={0:f}, std={1:f}, empirical p-value={2:g}'.format(fcs.mean(), fcs.std(), overlap_pvalue))
+
+    log('Step3: Merging common peaks')
+    with report.stage('merge', common1=get_peaks_size(pks1_com), common2=get_peaks_size(pks2_com),
+                      restored=saved.get('merge') is not None):
+        if saved.get('merge') is not None:
+            merged_pks = table_from_arrays(saved['merge'], '')
+            summit_dist = chrm_arrays_from(saved['merge'], '', 'summit_dist')
+        else:
+            merged_pks, summit_dist = merge_common_peaks(pks1_com, pks2_com, processes)
+    report.add_counts('merge', merged=get_peaks_size(merged_pks))
+    log('merged peaks: %d' % get_peaks_size(merged_pks))
+    if get_peaks_size(merged_pks) == 0:
+        raise ValueError('No common peaks!!')
+    if saved.get('merge') is None:
+        arrays = table_arrays('', merged_pks)
+        arrays['summit_dist'] = np.concatenate([summit_dist[chrm] for chrm in merged_pks.keys()])
+        checkpoints.save('merge', arrays)
+    # 分组后的peaks是各自独立的PeakTable，需要分别计算
+    return (pks1_uniq, pks1_com, pks2_uniq, pks2_com, merged_pks), summit_dist, fcs, overlap_pvalue
+
+
+def _read_counts_arrays(pks_5set, reads_num1, reads_num2):
+    arrays = {'reads_num': np.array([reads_num1, reads_num2], dtype=np.int64)}
+    for i, pks in enumerate(pks_5set):
+        arrays.update(table_arrays('%d_' % i, pks, ('read_count1', 'read_count2')))
+    return arrays
+
+
+def _restore_read_counts(pks_5set, saved_density, ext):
+    """
+    把检查点中的read数填回各组peaks并计算read density，检查点与peaks不一致时不做任何修改
+    :return: 两个样本的reads总数，没有恢复时为None
+    """
+    if saved_density is None:
+        return None
+    restored = []
+    for i, pks in enumerate(pks_5set):
+        counts1 = chrm_arrays_from(saved_density, '%d_' % i, 'read_count1')
+        counts2 = chrm_arrays_from(saved_density, '%d_' % i, 'read_count2')
+        if sorted(counts1.keys()) != sorted(pks.keys()) or \
+                any(counts1[chrm].size != pks.chrm_size(chrm) for chrm in pks.keys()):
+            return None
+        restored.append((counts1, counts2))
+    for pks, (counts1, counts2) in zip(pks_5set, restored):
+        for chrm in pks.keys():
+            cols = pks.columns(chrm)
+            cols['read_count1'][:], cols['read_count2'][:] = counts1[chrm], counts2[chrm]
+        cal_peaks_read_density_from_counts(pks, ext)
+    return tuple(saved_density['reads_num'].tolist())
+
+
+def _fit_and_normalize(pks_5set, summit_dist, min_smt_dist, report, log, fit_max_points=None, checkpoints=None,
+                       saved_fit=None, **counts):
+    """
+    Step5 - Step6: 用merged common peaks拟合模型并标准化所有peaks
+    :param saved_fit: 检查点中保存的模型，给出时不再拟合
+    :return: ma_fit, 拟合信息
+    """
+    merged_pks = pks_5set[-1]
+    log('Step5: Using merged common peaks to fitting all peaks')
+    with report.stage('fit', merged=get_peaks_size(merged_pks), restored=saved_fit is not None, **counts):
+        if saved_fit is not None:
+            ma_fit, fit_info = saved_fit['ma_fit'], json.loads(saved_fit['fit_info'].item())
+        else:
+            ma_fit, fit_info = use_merged_peaks_fit_model(merged_pks, summit_dist, min_smt_dist, fit_max_points, True)
+            if checkpoints is not None:
+                checkpoints.save('fit', {'ma_fit': ma_fit, 'fit_info': np.array(json.dumps(fit_info))})
+    report.add_counts('fit', **fit_info)
+    if fit_info['points'] < fit_info['total_points']:
+        log('fit the model on %d of %d peaks' % (fit_info['points'], fit_info['total_points']))
+    if not fit_info['converged']:
+        print '@warning: the robust fit did not converge in %d iterations!' % fit_info['iterations']
+    log('Model for normalization: ' + format_ma_model(ma_fit[1], ma_fit[0]))
+
+    log('Step6: Normalizing all peaks')
+    with report.stage('normalize', peaks=sum(get_peaks_size(pks) for pks in pks_5set), **counts):
+        for pks in pks_5set:
+            normalize_peaks(pks, ma_fit)
+    return ma_fit, fit_info
+
+
+def _make_result(names, pks_5set, summit_dist, ma_fit, fit_info, fcs, overlap_pvalue, params, report):
+    pks1_uniq, pks1_com, pks2_uniq, pks2_com, merged_pks = pks_5set
+    return MAnormResult(
+        pks1_name=names[0], pks2_name=names[1], reads1_name=names[2], reads2_name=names[3],
+        pks1_unique=pks1_uniq, pks1_common=pks1_com, pks2_unique=pks2_uniq, pks2_common=pks2_com,
+        merged_pks=merged_pks, summit_dist=summit_dist, ma_fit=ma_fit, fit_info=fit_info, fold_changes=fcs,
+        overlap_pvalue=overlap_pvalue, params=params, report=report
+    )
+
+
+def run_extension_sweep(peaks1, peaks2, reads1, reads2, extensions, shift1=100, shift2=100, min_smt_dist=None,
+                        random_time=5, seed=None, processes=1, chunk_memory=READS_CHUNK_MEMORY, use_index=False,
+                        index_dir=None, names=None, verbose=False, report=None, bam_options=None,
+                        fit_max_points=None):
+    """
+    在一次运行中比较多个延伸长度：peaks和reads只读一次，分组、随机重排检验和合并只做一次，
+    reads建成ReadsCoverage后一次查询出所有延伸长度下的read数，再分别拟合模型和标准化
+    :param extensions: 延伸长度的列表
+    :param min_smt_dist: 所有延伸长度共用的summit距离上限，默认为各自的ext / 2
+    其它参数与run_manorm相同(不支持流式模式)
+    :return: 与extensions一一对应的MAnormResult，它们共用同一个report
+    """
+    extensions = list(extensions)
+    names, report, log = _run_context(peaks1, peaks2, reads1, reads2, names, verbose, report)
+    log('Reading Data, please wait for a while...')
+    pks1, pks2 = _read_peak_inputs(peaks1, peaks2, report)
+    reads_pos1, reads_pos2 = _read_reads_inputs(
+        reads1, reads2, shift1, shift2, chunk_memory, use_index, index_dir, processes, report, bam_options)
+    pks_5set, summit_dist, fcs, overlap_pvalue = _classify_and_merge(
+        pks1, pks2, names, random_time, seed, processes, report, log)
+    pks_num = sum(get_peaks_size(pks) for pks in pks_5set)
+
+    log('Step4: Calculating peaks read density, extensions: %s' % ', '.join(str(ext) for ext in extensions))
+    with report.stage('density', peaks=pks_num, extensions=extensions):
+        coverage1, coverage2 = ReadsCoverage(reads_pos1), ReadsCoverage(reads_pos2)
+        # sweep_sets[i][j]: 第i组peaks在第j个延伸长度下的PeakTable
+        sweep_sets = [cal_peaks_read_density_sweep(pks, coverage1, coverage2, extensions, processes)
+                      for pks in pks_5set]
+    report.add_counts('density', reads1=coverage1.total(), reads2=coverage2.total())
+
+    results = []
+    for j, ext in enumerate(extensions):
+        log('Extension %d:' % ext)
+        ext_5set = tuple(tables[j] for tables in sweep_sets)
+        ext_smt_dist = min_smt_dist if min_smt_dist is not None else ext / 2
+        ma_fit, fit_info = _fit_and_normalize(ext_5set, summit_dist, ext_smt_dist, report, log, fit_max_points,
+                                              ext=ext)
+        params = {'shift1': shift1, 'shift2': shift2, 'ext': ext, 'min_smt_dist': ext_smt_dist,
+                  'random_time': random_time, 'seed': seed, 'stream': False, 'fit_max_points': fit_max_points}
+        results.append(_make_result(names, ext_5set, summit_dist, ma_fit, fit_info, fcs, overlap_pvalue, params,
+                                    report))
+    return results
+
+
+# extension_sweep.xls的列
+SWEEP_FIELDS = ('ext', 'min_smt_dist', 'fit_peaks', 'slope', 'intercept', 'fit_iterations', 'residual_mad',
+                'merged_normed_m_sd', 'merged_median_count1', 'merged_median_count2')
+
+
+def summarize_extension_sweep(results):
+    """
+    比较不同延伸长度下的模型：
+    fit_peaks是参与拟合的peaks数，residual_mad是这些peaks的M值相对于拟合直线的残差的MAD(已乘1.4826，
+    与标准差可比)，merged_normed_m_sd是标准化后所有merged common peaks的M值的标准差，
+    merged_median_count1/2是merged common peaks窗口内read数的中位数
+    :param results: run_extension_sweep的结果
+    :return: [{列名: 值}, ...]
+    """
+    rows = []
+    for result in results:
+        fit_a, fit_m = select_fit_peaks(result.merged_pks, result.summit_dist, result.params['min_smt_dist'])
+        residuals = fit_m - (result.ma_fit[1] * fit_a + result.ma_fit[0])
+        residual_mad = 1.4826 * np.median(np.abs(residuals - np.median(residuals))) if residuals.size else np.nan
+        rows.append({
+            'ext': result.params['ext'], 'min_smt_dist': result.params['min_smt_dist'], 'fit_peaks': fit_a.size,
+            'slope': result.ma_fit[1], 'intercept': result.ma_fit[0], 'fit_iterations': result.fit_info['iterations'],
+            'residual_mad': residual_mad,
+            'merged_normed_m_sd': result.merged_pks.column('normed_mvalue').std(),
+            'merged_median_count1': np.median(result.merged_pks.column('read_count1')),
+            'merged_median_count2': np.median(result.merged_pks.column('read_count2')),
+        })
+    return rows
+
+
+def write_extension_sweep(rows, sweep_fp):
+    with open(sweep_fp, 'w') as fo:
+        fo.write('\t'.join(SWEEP_FIELDS) + '\n')
+        for row in rows:
+            fo.write('\t'.join(str(row[field]) for field in SWEEP_FIELDS) + '\n')
+
+
+# write_manorm_outputs写出的目录和文件名后缀，以及命令行写出的运行报告
+_OUTPUT_DIRS = ('output_figures', 'output_filters', 'output_wig_files')
+_OUTPUT_SUFFIXES = ('_MAvalues.xls', '_MAvalues.xls.gz')
+_REPORT_FILES = ('run_report.json', 'profile.prof', 'profile.txt')
+
+
+def clear_manorm_outputs(output_dir):
+    """
+    删除output_dir中以前的运行写出的结果(其它文件和检查点目录保留)，
+    用不同的阈值重新输出时不会留下按旧阈值命名的filter文件
+    """
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name in _OUTPUT_DIRS and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path) and (name.endswith(_OUTPUT_SUFFIXES) or name in _REPORT_FILES):
+            os.remove(path)
+
+
+def write_manorm_outputs(result, output_dir, comparison_name=None, output_no_merge=False, figures='full',
+                         unbiased_mvalue=1., biased_mvalue=1., biased_pvalue=0.01, overlap_dependent=False,
+                         compress=False, track_format='wig', chrom_sizes=None):
+    """
+    把run_manorm的结果写到output_dir(不存在时创建)，所有文件都用明确的路径写出，不改变工作目录：
+    <comparison_name>_all_peak_MAvalues.xls, output_no_merge时的<peaks名>_MAvalues.xls,
+    output_figures/(figures为'none'时不创建), output_wig_files/和output_filters/
+    :param comparison_name: 输出文件名的前缀，默认为output_dir的目录名
+    :param figures: 'none', 'fast'或'full'，图在子进程中与wig, filter文件同时输出
+    """
+    if comparison_name is None:
+        comparison_name = os.path.basename(os.path.normpath(output_dir))
+    report = result.report
+    fig_dir, filter_dir, wig_dir = [os.path.join(output_dir, name) for name in _OUTPUT_DIRS]
+    folders = [output_dir, filter_dir, wig_dir]
+    if figures != 'none':
+        folders.append(fig_dir)
+    for folder in folders:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    pks1_uniq, pks1_com, pks2_uniq, pks2_com, merged_pks = result.peak_tables()
+    names = (result.pks1_name, result.pks2_name, result.reads1_name, result.reads2_name)
+    if output_no_merge:
+        with report.stage('output_no_merge', peaks=result.peaks_size() - get_peaks_size(merged_pks)):
+            output_normalized_peaks(pks1_uniq, pks1_com, os.path.join(output_dir, names[0] + '_MAvalues.xls'),
+                                    names[2], names[3], compress)
+            output_normalized_peaks(pks2_uniq, pks2_com, os.path.join(output_dir, names[1] + '_MAvalues.xls'),
+                                    names[2], names[3], compress)
+    pks_3set_num = get_peaks_size(pks1_uniq) + get_peaks_size(merged_pks) + get_peaks_size(pks2_uniq)
+    with report.stage('output_all_peaks', peaks=pks_3set_num):
+        output_3set_normalized_peaks(
+            pks1_uniq, merged_pks, pks2_uniq, os.path.join(output_dir, comparison_name + '_all_peak_MAvalues.xls'),
+            names[0], names[1], names[2], names[3], compress)
+
+    figs_proc = None
+    if figures != 'none':
+        # 作图与写wig, filter文件同时进行
+        report.begin('output_figures')
+        figs_proc = start_background(
+            draw_figs_to_show_data,
+            (pks1_uniq, pks2_uniq, merged_pks, names[0], names[1], result.ma_fit, names[2], names[3]),
+            {'mode': figures, 'fig_dir': fig_dir}
+        )
+    with report.stage('output_tracks_and_filters', peaks=pks_3set_num):
+        output_peaks_tracks_and_filters(
+            pks1_uniq, pks2_uniq, merged_pks, comparison_name, unbiased_mvalue, biased_mvalue, biased_pvalue,
+            overlap_dependent, wig_dir, filter_dir, compress, track_format, chrom_sizes)
+    if figures != 'none':
+        figs_ok = join_background(figs_proc)
+        report.end('output_figures', peaks=pks_3set_num, mode=figures)
+        if not figs_ok:
+            print '@warning: failed to draw figures!'
+
+
+def test_as_peak_table():
+    import tempfile
+    expected = {'chr1': ([100, 500], [300, 900], [150, 701]), 'chr2': ([50], [250], [151])}
+
+    def check(pks):
+        assert sorted(pks.keys()) == ['chr1', 'chr2']
+        for chrm, cols in expected.items():
+            for name, values in zip(('start', 'end', 'summit'), cols):
+                assert pks.columns(chrm)[name].tolist() == values, (chrm, name)
+
+    peak_list = [Peak('chr1', 100, 300, 50), Peak('chr1', 500, 900), Peak('chr2', 50, 250)]
+    check(as_peak_table(peak_list))
+    check(as_peak_table({'chr1': peak_list[:2], 'chr2': peak_list[2:]}))
+    check(as_peak_table({chrm: cols for chrm, cols in expected.items()}))
+    check(as_peak_table({'chr1': ([100, 500], [300, 900], [150, 701]), 'chr2': ([50], [250])}))
+    table = as_peak_table(expected)
+    assert as_peak_table(table) is table
+    with tempfile.NamedTemporaryFile(suffix='.bed') as fo:
+        fo.write('chr1\t100\t300\t50\nchr1\t500\t900\nchr2\t50\t250\n')
+        fo.flush()
+        check(as_peak_table(fo.name))
+    print 'Done.'
+
+
+if __name__ == '__main__':
+    test_as_peak_table()
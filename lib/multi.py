@@ -0,0 +1,232 @@
+# coding=utf-8
+# 多样本比较：把所有样本的peaks合并成一组union peaks，每个reads文件只在union peaks上统计一次read数，
+# 再在read数矩阵上对所有样本对(或每个样本对参考样本)拟合模型、标准化，输出一个M值、P值矩阵
+import json
+import os
+
+import numpy as np
+
+from MAnorm_io import READS_CHUNK_MEMORY, read_peaks, read_reads, output_mvalue_matrix
+from parallel import map_shared
+from peaks import get_peaks_size, build_union_peaks, count_window_reads, fit_ma_model, \
+    format_ma_model, rescale_log2_density, cal_pvalues
+from profiling import RunReport
+
+# 样本表中每个样本的字段，shift可以省略
+SAMPLE_FIELDS = ('name', 'peaks', 'reads', 'shift')
+_REQUIRED_FIELDS = SAMPLE_FIELDS[:3]
+_DEFAULT_SHIFT = 100
+
+
+def _check_samples(samples, sheet_fp):
+    names = set()
+    for i, sample in enumerate(samples):
+        missing = [field for field in _REQUIRED_FIELDS if not sample.get(field)]
+        if missing:
+            raise ValueError('%s: sample %d misses %s' % (sheet_fp, i + 1, ', '.join(missing)))
+        if sample['name'] in names:
+            raise ValueError('%s: duplicated sample name "%s"' % (sheet_fp, sample['name']))
+        names.add(sample['name'])
+        sample['shift'] = int(sample.get('shift') or _DEFAULT_SHIFT)
+        # 相对路径都相对于样本表所在的目录
+        for field in ('peaks', 'reads'):
+            sample[field] = os.path.join(os.path.dirname(os.path.abspath(sheet_fp)), sample[field])
+    if len(samples) < 2:
+        raise ValueError('%s: at least 2 samples are needed' % sheet_fp)
+    return samples
+
+
+def read_sample_sheet(sheet_fp):
+    """
+    读取多样本比较的样本表，支持两种格式：
+    1. 制表符分隔的文本，每行一个样本：name, peaks, reads[, shift]，以#开头的行和以name开头的表头会跳过
+    2. .json文件，内容是由上述字段组成的对象的列表，或者{"samples": [...]}
+    文件路径可以是相对于样本表所在目录的相对路径
+    :return: [{字段: 值}, ...]
+    """
+    if sheet_fp.endswith('.json'):
+        with open(sheet_fp) as fi:
+            samples = json.load(fi)
+        if isinstance(samples, dict):
+            samples = samples['samples']
+        samples = [{field: sample.get(field) for field in SAMPLE_FIELDS} for sample in samples]
+    else:
+        samples = []
+        with open(sheet_fp) as fi:
+            for li in fi:
+                sli = [x.strip() for x in li.rstrip('\r\n').split('\t')]
+                if not li.strip() or li.startswith('#') or sli[0] == 'name':
+                    continue
+                samples.append(dict(zip(SAMPLE_FIELDS, sli)))
+    return _check_samples(samples, sheet_fp)
+
+
+def sample_pairs(names, reference=None):
+    """
+    :param reference: 参考样本名，给出时每个其它样本都与它比较，否则比较所有样本对
+    :return: [(样本1下标, 样本2下标), ...]，M = log2(样本1 / 样本2)
+    """
+    if reference is None:
+        return [(i, j) for i in xrange(len(names)) for j in xrange(i + 1, len(names))]
+    if reference not in names:
+        raise ValueError('reference sample "%s" is not in the samples' % reference)
+    ref = list(names).index(reference)
+    return [(i, ref) for i in xrange(len(names)) if i != ref]
+
+
+def _count_sample_reads(idx, shared):
+    """
+    读取一个样本的reads，统计它在所有union peaks上的read数，返回后reads位点即被释放
+    :return: 按union_pks.keys()顺序首尾相连的read数数组
+    """
+    union_pks, samples, ext, chunk_memory, use_index, index_dir, bam_options = shared
+    sample = samples[idx]
+    reads_pos = read_reads(sample['reads'], sample['shift'], chunk_memory, use_index, index_dir, bam_options)
+    counts = [count_window_reads(union_pks.columns(chrm)['summit'], [reads_pos.get(chrm)], ext)[0]
+              for chrm in union_pks.keys()]
+    return np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64), \
+        sum(pos.size for pos in reads_pos.values())
+
+
+class MultiResult(object):
+    """
+    run_multi的结果，矩阵的行与union_pks.column()的顺序一致
+    names: 样本名; union_pks: union peaks; sample_summits: (peaks数, 样本数)的summit矩阵，-1表示样本在这里没有peak
+    read_counts: (peaks数, 样本数)的read数矩阵(已加1); read_density: 对应的read density
+    pairs: [(样本1下标, 样本2下标), ...]; ma_fits: 每对样本的(截距, 斜率); fit_peaks: 每对样本参与拟合的peaks数
+    mvalues, avalues, pvalues: (peaks数, 样本对数)的标准化后的M值、A值、P值矩阵
+    """
+    def __init__(self, **kwargs):
+        for name in ('names', 'union_pks', 'sample_summits', 'read_counts', 'read_density', 'pairs', 'ma_fits',
+                     'fit_peaks', 'mvalues', 'avalues', 'pvalues', 'params', 'report'):
+            setattr(self, name, kwargs.pop(name))
+
+    def pair_names(self):
+        return ['%s_vs_%s' % (self.names[i], self.names[j]) for i, j in self.pairs]
+
+
+def fit_pairs(log2_density, sample_summits, pairs, min_smt_dist, max_points=None):
+    """
+    对每对样本用两者都有peak、且两个summit距离不超过min_smt_dist的union peaks拟合模型
+    :param max_points: 见huber_line_fit
+    :return: (样本对数, 2)的ma_fit数组, 每对样本参与拟合的peaks数, 每对样本的拟合信息
+    """
+    ma_fits, fit_peaks = np.zeros((len(pairs), 2)), np.zeros(len(pairs), dtype=np.int64)
+    fit_infos = []
+    for k, (i, j) in enumerate(pairs):
+        mvalues = log2_density[:, i] - log2_density[:, j]
+        selected = (sample_summits[:, i] >= 0) & (sample_summits[:, j] >= 0) & \
+            (np.abs(sample_summits[:, i] - sample_summits[:, j]) <= min_smt_dist) & \
+            (mvalues >= -10) & (mvalues <= 10)
+        fit_peaks[k] = np.count_nonzero(selected)
+        if fit_peaks[k] < 3:
+            raise ValueError('%d common peaks of samples %d and %d for fitting the model' % (fit_peaks[k], i + 1,
+                                                                                            j + 1))
+        avalues = (log2_density[selected, i] + log2_density[selected, j]) / 2.
+        ma_fits[k], info = fit_ma_model(avalues, mvalues[selected], max_points, True)
+        fit_infos.append(info)
+    return ma_fits, fit_peaks, fit_infos
+
+
+def normalize_pairs(read_density, pairs, ma_fits):
+    """
+    在read density矩阵上一次标准化所有样本对：把每对中样本1的read density调整到样本2的水平
+    :return: (peaks数, 样本对数)的M值、A值、P值矩阵
+    """
+    first, second = [np.array([pair[n] for pair in pairs], dtype=np.int64) for n in (0, 1)]
+    log2_density2 = np.log2(read_density[:, second])
+    normed_log2_density1 = rescale_log2_density(np.log2(read_density[:, first]), (ma_fits[:, 0], ma_fits[:, 1]))
+    mvalues, avalues = normed_log2_density1 - log2_density2, (normed_log2_density1 + log2_density2) / 2.
+    pvalues, _ = cal_pvalues(np.exp2(normed_log2_density1).ravel(), read_density[:, second].ravel())
+    return mvalues, avalues, pvalues.reshape(mvalues.shape)
+
+
+def run_multi(samples, ext=1000, min_smt_dist=None, reference=None, processes=1, chunk_memory=READS_CHUNK_MEMORY,
+              use_index=False, index_dir=None, bam_options=None, verbose=False, report=None, fit_max_points=None):
+    """
+    多样本比较：合并所有样本的peaks，每个reads文件在union peaks上只统计一次read数(processes个样本同时读)，
+    然后在read数矩阵上拟合并标准化所有样本对。
+    与两两比较的MAnorm不同，read density都在union peaks的summit上统计，
+    拟合模型时两个样本的summit距离取各自在这个union peak中最接近union summit的peak
+    :param samples: read_sample_sheet的结果，或者有name, peaks(文件路径或PeakTable), reads, shift的字典列表
+    :param reference: 参考样本名，给出时只比较每个样本与参考样本
+    :param fit_max_points: 每对样本用于拟合的peaks超过这个数量时按固定的随机种子抽样拟合
+    :return: MultiResult
+    """
+    if min_smt_dist is None:
+        min_smt_dist = ext / 2
+    report = report if report is not None else RunReport()
+    names = [sample['name'] for sample in samples]
+    pairs = sample_pairs(names, reference)
+
+    def log(msg):
+        if verbose:
+            print msg
+
+    log('Reading peaks of %d samples' % len(samples))
+    with report.stage('read_peaks', samples=len(samples)):
+        pks_list = [read_peaks(sample['peaks']) if isinstance(sample['peaks'], basestring) else sample['peaks']
+                    for sample in samples]
+    report.add_counts('read_peaks', peaks=sum(get_peaks_size(pks) for pks in pks_list))
+
+    log('Step1: Merging peaks of all samples into union peaks')
+    with report.stage('union', peaks=sum(get_peaks_size(pks) for pks in pks_list)):
+        union_pks, chrm_summits = build_union_peaks(pks_list, processes)
+    report.add_counts('union', union=get_peaks_size(union_pks))
+    log('union peaks: %d' % get_peaks_size(union_pks))
+    if get_peaks_size(union_pks) == 0:
+        raise ValueError('No peaks!!')
+    sample_summits = np.concatenate([chrm_summits[chrm] for chrm in union_pks.keys()])
+
+    log('Step2: Counting reads of %d samples on union peaks' % len(samples))
+    with report.stage('count', peaks=get_peaks_size(union_pks), samples=len(samples)):
+        shared = (union_pks, samples, ext, chunk_memory, use_index, index_dir, bam_options)
+        sample_counts = map_shared(_count_sample_reads, range(len(samples)), shared, processes)
+        # 加1是为了保证每个peak的read count初始为1
+        read_counts = np.column_stack([sample_counts[k][0] + 1 for k in xrange(len(samples))])
+        read_density = read_counts * 1000. / (2. * ext)
+    report.add_counts('count', reads=[int(sample_counts[k][1]) for k in xrange(len(samples))])
+
+    log('Step3: Fitting models of %d sample pairs' % len(pairs))
+    with report.stage('fit', pairs=len(pairs)):
+        ma_fits, fit_peaks, fit_infos = fit_pairs(np.log2(read_density), sample_summits, pairs, min_smt_dist,
+                                                  fit_max_points)
+    report.add_counts('fit', iterations=[info['iterations'] for info in fit_infos],
+                      converged=[info['converged'] for info in fit_infos])
+    for k, (i, j) in enumerate(pairs):
+        if not fit_infos[k]['converged']:
+            print '@warning: the robust fit of %s vs %s did not converge!' % (names[i], names[j])
+        log('%s vs %s: %s (%d peaks)' % (names[i], names[j], format_ma_model(ma_fits[k, 1], ma_fits[k, 0]),
+                                           fit_peaks[k]))
+
+    log('Step4: Normalizing all sample pairs')
+    with report.stage('normalize', peaks=get_peaks_size(union_pks), pairs=len(pairs)):
+        mvalues, avalues, pvalues = normalize_pairs(read_density, pairs, ma_fits)
+
+    params = {'ext': ext, 'min_smt_dist': min_smt_dist, 'reference': reference, 'fit_max_points': fit_max_points}
+    return MultiResult(names=names, union_pks=union_pks, sample_summits=sample_summits, read_counts=read_counts,
+                       read_density=read_density, pairs=pairs, ma_fits=ma_fits, fit_peaks=fit_peaks, mvalues=mvalues,
+                       avalues=avalues, pvalues=pvalues, params=params, report=report)
+
+
+def write_multi_outputs(result, output_dir, comparison_name=None, compress=False):
+    """
+    把run_multi的结果写到output_dir(不存在时创建)：
+    <comparison_name>_matrix.xls: 每个union peak一行，各样本是否有peak、read density，以及每对样本的M值和P值
+    <comparison_name>_pair_models.xls: 每对样本的模型和参与拟合的peaks数
+    :param comparison_name: 输出文件名的前缀，默认为output_dir的目录名
+    """
+    if comparison_name is None:
+        comparison_name = os.path.basename(os.path.normpath(output_dir))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    names = result.names
+    with result.report.stage('output', peaks=get_peaks_size(result.union_pks), pairs=len(result.pairs)):
+        output_mvalue_matrix(result.union_pks, names, result.sample_summits >= 0, result.read_density,
+                             result.pair_names(), result.mvalues, result.pvalues,
+                             os.path.join(output_dir, comparison_name + '_matrix.xls'), compress)
+        with open(os.path.join(output_dir, comparison_name + '_pair_models.xls'), 'w') as fo:
+            fo.write('\t'.join(['sample1', 'sample2', 'fit_peaks', 'slope', 'intercept']) + '\n')
+            for k, (i, j) in enumerate(result.pairs):
+                fo.write('\t'.join([names[i], names[j], str(result.fit_peaks[k]), str(result.ma_fits[k, 1]),
+                                    str(result.ma_fits[k, 0])]) + '\n')
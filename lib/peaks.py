@@ -1,348 +1,786 @@
 # coding=utf-8
-from bisect import bisect_left, bisect_right
-from math import log, exp
-from scipy.misc import comb
-import random
+from math import log
 import numpy as np
-from statsmodels import api as sm
+
+from parallel import map_chrms
+
+
+# PeakTable中每个peak的列及其数据类型
+_PEAK_COLUMNS = (
+    ('start', np.int64), ('end', np.int64), ('summit', np.int64),
+    ('read_count1', np.int64), ('read_count2', np.int64),
+    ('read_density1', np.float64), ('read_density2', np.float64),
+    ('normed_read_density1', np.float64),
+    ('mvalue', np.float64), ('avalue', np.float64),
+    ('normed_mvalue', np.float64), ('normed_avalue', np.float64),
+    ('pvalue', np.float64), ('neg_log10_pvalue', np.float64),
+    ('group', np.int8),
+)
+_PEAK_COLUMN_DTYPES = dict(_PEAK_COLUMNS)
+
+# peak的分组标签
+GROUP_NONE, GROUP_UNIQUE, GROUP_COMMON, GROUP_MERGED = 0, 1, 2, 3
+
+
+def _new_columns(size):
+    """
+    新建一组长度为size、值全为0的peak列
+    """
+    return {name: np.zeros(size, dtype=dtype) for name, dtype in _PEAK_COLUMNS}
 
 
 class Peak(object):
     """
     Peak是蛋白质结合在基因组上的信号
+    数据实际保存在PeakTable的列中，Peak只是其中一行的视图，保留它是为了兼容逐个peak处理的接口
     """
+    __slots__ = ('chrm', '_cols', '_idx')
+
     def __init__(self, c, s, e, smt=None):
+        # 单独创建的peak用只有一行的列来保存数据
         self.chrm = c
+        self._cols = _new_columns(1)
+        self._idx = 0
         self.start = s
         self.end = e
         if smt is None:
             self.summit = (s + e) / 2 + 1
         else:
             self.summit = smt + s
-        # MAnorm因为输入是两个read文件，对一个peak用这两个read文件计算两次read count
-        self.read_count1, self.read_density1 = 0, 0.
-        self.normed_read_density1 = 0, 0.
-        self.read_count2, self.read_density2 = 0, 0.
-        self.mvalue, self.avalue = 0., 0.
-        self.normed_mvalue, self.normed_avalue, self.pvalue = 0., 0., 0.
 
-    def set_summit(self, smt):
-        self.summit = smt
-
-    def __cal_read_count(self, reads_pos, ext):
+    @classmethod
+    def view(cls, chrm, cols, idx):
         """
-        根据给定的reads的位点信息计算落在此peak的read数
-        :param reads_pos: 不同染色体reads的位点升序list组成的字典
-        :return: 落在此peak的read数
+        返回染色体chrm的列cols中第idx行的视图，对视图属性的修改会写回列中
         """
-        if self.chrm not in reads_pos.keys():
-            return 0
-        re_start, re_end = self.summit - ext - 1, self.summit + ext
-        si = bisect_left(reads_pos[self.chrm], re_start)
-        ei = bisect_right(reads_pos[self.chrm], re_end)
-        # print '%d(%d)--%d(%d)' % (si, re_start, ei, re_end)
-        try:
-            if re_end == reads_pos[self.chrm][ei]:
-                return ei - si + 1
-            else:
-                return ei - si
-        except IndexError:
-            return ei - si
+        pk = cls.__new__(cls)
+        pk.chrm, pk._cols, pk._idx = chrm, cols, idx
+        return pk
+
+    def set_summit(self, smt):
+        self.summit = smt
 
     def __cal_read_density(self, reads_pos, ext):
-        read_count = self.__cal_read_count(reads_pos, ext) + 1  # 加1是为了保证每个peak的read count初始为1
+        read_count = count_window_reads(np.array([self.summit]), [reads_pos.get(self.chrm)], ext)[0][0] + 1
         read_density = read_count * 1000. / (2. * ext)
         return read_count, read_density
 
     def cal_read_density(self, reads_pos1, reads_pos2, ext):
         self.read_count1, self.read_density1 = self.__cal_read_density(reads_pos1, ext)
         self.read_count2, self.read_density2 = self.__cal_read_density(reads_pos2, ext)
-        self.mvalue = log(self.read_density1, 2) - log(self.read_density2, 2)
-        self.avalue = (log(self.read_density1, 2) + log(self.read_density2, 2)) / 2
+        self.mvalue, self.avalue = cal_mavalues(self.read_density1, self.read_density2)
 
     def normalize_mavalue(self, ma_fit):
         """
         ma_fit: R2 = ma_fit[0] * R1 + ma_fit[1]
         """
-        # key method for normalizing read density
-        normed_log2_density1 = \
-            (2. - ma_fit[1]) * log(self.read_density1, 2) / (2. + ma_fit[1]) - 2. * ma_fit[0] / (2. + ma_fit[1])
-        self.normed_read_density1 = 2 ** normed_log2_density1
-
-        self.normed_mvalue = normed_log2_density1 - log(self.read_density2, 2)
-        self.normed_avalue = (normed_log2_density1 + log(self.read_density2, 2)) / 2.
-        self.pvalue = _digit_exprs_p_norm(2. ** normed_log2_density1, self.read_density2)
-
-    def isoverlap(self, other_pk):
-        if self.start <= other_pk.start < self.end or self.start < other_pk.end <= self.end:
-            return True
+        self.normed_read_density1, self.normed_mvalue, self.normed_avalue = \
+            normalize_mavalues(self.read_density1, self.read_density2, ma_fit)
+        pvalue, neg_log10_pvalue = cal_pvalues([self.normed_read_density1], [self.read_density2])
+        self.pvalue, self.neg_log10_pvalue = pvalue[0], neg_log10_pvalue[0]
+
+
+def _column_property(name):
+    def fget(self):
+        return self._cols[name][self._idx].item()
+
+    def fset(self, value):
+        self._cols[name][self._idx] = value
+
+    return property(fget, fset)
+
+
+for _name, _ in _PEAK_COLUMNS:
+    setattr(Peak, _name, _column_property(_name))
+
+
+class PeakTable(object):
+    """
+    按列存储的peaks，用来代替以前的{chrm: [Peak, ...]}字典。
+    每条染色体对应一组等长的numpy数组（start, end, summit, read count, read density, M/A/P值, 分组）
+    """
+    def __init__(self):
+        self._blocks = {}
+
+    @classmethod
+    def from_peaks(cls, pks):
+        """
+        把{chrm: [Peak, ...]}形式的peaks字典转换为PeakTable
+        """
+        table = cls()
+        for chrm in pks.keys():
+            cols = _new_columns(len(pks[chrm]))
+            for i, pk in enumerate(pks[chrm]):
+                for name, _ in _PEAK_COLUMNS:
+                    cols[name][i] = getattr(pk, name, 0)
+            table.set_columns(chrm, cols)
+        return table
+
+    def add_chrm(self, chrm, starts, ends, summits=None, group=GROUP_NONE):
+        """
+        添加（或替换）一条染色体上的peaks
+        :param summits: summit的绝对位置，为None时使用peak的中心
+        :return: 这条染色体的列
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        cols = _new_columns(starts.size)
+        cols['start'][:], cols['end'][:] = starts, ends
+        if summits is None:
+            cols['summit'][:] = (starts + ends) // 2 + 1
         else:
-            return False
+            cols['summit'][:] = summits
+        cols['group'][:] = group
+        self._blocks[chrm] = cols
+        return cols
 
+    def set_columns(self, chrm, cols):
+        self._blocks[chrm] = cols
 
-def _digit_exprs_p_norm(x, y):
+    def copy(self):
+        """
+        :return: 所有列都复制一份的PeakTable
+        """
+        table = PeakTable()
+        for chrm, cols in self._blocks.items():
+            table.set_columns(chrm, {name: values.copy() for name, values in cols.items()})
+        return table
+
+    def columns(self, chrm):
+        """
+        :return: 染色体chrm上的列字典{列名: 数组}
+        """
+        return self._blocks[chrm]
+
+    def take(self, chrm, idx):
+        """
+        按下标（或布尔数组）复制出染色体chrm上的一部分peaks的列
+        """
+        return {name: values[idx] for name, values in self._blocks[chrm].items()}
+
+    def column(self, name):
+        """
+        :return: 所有染色体上名为name的列首尾相连成的数组，染色体的顺序与keys()一致
+        """
+        if not self._blocks:
+            return np.zeros(0, dtype=_PEAK_COLUMN_DTYPES[name])
+        return np.concatenate([self._blocks[chrm][name] for chrm in self.keys()])
+
+    def chrm_column(self):
+        """
+        :return: 与column()对应的每个peak所在染色体名的数组
+        """
+        keys = self.keys()
+        return np.repeat(np.array(keys, dtype=object), [self.chrm_size(chrm) for chrm in keys])
+
+    def chrm_size(self, chrm):
+        return self._blocks[chrm]['start'].size if chrm in self._blocks else 0
+
+    def size(self):
+        """
+        :return: 所有染色体上peaks的总数
+        """
+        return sum(cols['start'].size for cols in self._blocks.values())
+
+    def keys(self):
+        return self._blocks.keys()
+
+    def __iter__(self):
+        return iter(self._blocks)
+
+    def __contains__(self, chrm):
+        return chrm in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __getitem__(self, chrm):
+        """
+        兼容以前的peaks字典，返回染色体chrm上所有peak的视图列表
+        """
+        cols = self._blocks[chrm]
+        return [Peak.view(chrm, cols, i) for i in xrange(cols['start'].size)]
+
+
+def _mavalues_of_log2(log2_density1, log2_density2):
+    return log2_density1 - log2_density2, (log2_density1 + log2_density2) / 2.
+
+
+def cal_mavalues(read_density1, read_density2):
+    """
+    由两个样本的read density数组计算M值和A值
+    :return: mvalues, avalues
+    """
+    return _mavalues_of_log2(np.log2(read_density1), np.log2(read_density2))
+
+
+def rescale_log2_density(log2_density1, ma_fit):
+    """
+    key method for normalizing read density: 用拟合的模型M = ma_fit[1] * A + ma_fit[0]
+    把样本1的log2 read density数组调整到样本2的水平
+    """
+    return (2. - ma_fit[1]) * log2_density1 / (2. + ma_fit[1]) - 2. * ma_fit[0] / (2. + ma_fit[1])
+
+
+def normalize_mavalues(read_density1, read_density2, ma_fit):
     """
-    利用read count相对于随机情况下计算p值
+    标准化样本1的read density并重新计算M值和A值
+    :return: normed_read_density1, normed_mvalues, normed_avalues
     """
-    xx = round(x)
-    if xx == 0:
-        xx = 1
-    yy = int(round(y))
-    if xx + yy < 20.0:  # if x + y small
-        p1 = round(comb(xx + yy, xx)) * 2 ** - (xx + yy + 1.0)
-        p2 = round(comb(xx + yy, yy)) * 2 ** - (xx + yy + 1.0)
-        return max(p1, p2)
-    else:  # if x + y large, use the approximate equations
-        log_p = (xx + yy) * log(xx + yy) - xx * log(xx) - yy * log(yy) - (xx + yy + 1.0) * log(2.0)
-        if log_p < -500:
-            log_p = -500
-        p = exp(log_p)
-        return p
+    normed_log2_density1 = rescale_log2_density(np.log2(read_density1), ma_fit)
+    normed_mvalues, normed_avalues = _mavalues_of_log2(normed_log2_density1, np.log2(read_density2))
+    return np.exp2(normed_log2_density1), normed_mvalues, normed_avalues
+
+
+def cal_pvalues(normed_read_density1, read_density2):
+    """
+    利用read count相对于随机情况下计算p值，对所有peak一次计算。
+    x + y < 20时用精确的二项分布C(x + y, x) / 2^(x + y + 1)，
+    更大时沿用MAnorm的近似公式(x + y)log(x + y) - x log(x) - y log(y) - (x + y + 1)log(2)
+    :param normed_read_density1: 标准化后样本1的read density数组
+    :param read_density2: 样本2的read density数组
+    :return: p值数组(与以前一样最小为exp(-500)), 没有下限、不会下溢的-log10(p)数组
+    """
+    from scipy.special import gammaln, xlogy
+    # read density都是正数，floor(v + 0.5)与python 2的round相同
+    xx = np.floor(np.asarray(normed_read_density1, dtype=np.float64) + 0.5)
+    xx[xx == 0] = 1
+    yy = np.floor(np.asarray(read_density2, dtype=np.float64) + 0.5)
+    nn = xx + yy
+    small, large = nn < 20.0, nn >= 20.0
+    pvalues, log_p = np.empty_like(nn), np.empty_like(nn)
+    # if x + y small, 组合数取整后与以前的comb结果完全一致
+    combs = np.round(np.exp(gammaln(nn[small] + 1.) - gammaln(xx[small] + 1.) - gammaln(yy[small] + 1.)))
+    pvalues[small] = np.ldexp(combs, -(nn[small] + 1).astype(np.int64))
+    log_p[small] = np.log(pvalues[small])
+    # if x + y large, use the approximate equations, xlogy(0, 0) = 0
+    log_p[large] = xlogy(nn[large], nn[large]) - xlogy(xx[large], xx[large]) - xlogy(yy[large], yy[large]) - \
+        (nn[large] + 1.0) * log(2.0)
+    pvalues[large] = np.exp(np.maximum(log_p[large], -500))
+    return pvalues, -log_p / log(10.)
 
 
 def get_peaks_size(pks):
     """
-    获取peaks字典的数据长度
+    获取peaks的数据长度
+    """
+    return pks.size()
+
+
+def count_window_reads(summits, reads_pos_list, ext):
+    """
+    计算一条染色体上所有以summit为中心的窗口[summit - ext - 1, summit + ext]内的read数，
+    每个样本只调用一次np.searchsorted
+    :param summits: 这条染色体上所有peak的summit数组
+    :param reads_pos_list: 各个样本在这条染色体上升序排列的read位点数组，没有read时为None
+    :return: 每个样本对应一个read数数组
+    """
+    summits = np.asarray(summits)
+    # read位点都是整数，窗口右端点取summit + ext + 1的左插入位置即可把summit + ext包含进来
+    bounds = np.vstack((summits - ext - 1, summits + ext + 1))
+    counts = []
+    for reads_pos in reads_pos_list:
+        if reads_pos is None or len(reads_pos) == 0:
+            counts.append(np.zeros(summits.size, dtype=np.int64))
+            continue
+        # 窗口边界转成与read位点相同的类型，避免searchsorted把整个位点数组复制一遍
+        reads_pos = np.asarray(reads_pos)
+        loc = np.searchsorted(reads_pos, bounds.astype(reads_pos.dtype, copy=False))
+        counts.append(loc[1] - loc[0])
+    return counts
+
+
+class ReadsCoverage(object):
+    """
+    reads的累积计数索引，由read_reads返回的升序位点建立一次：
+    位点数组本身就是每条染色体上累积read数的跳变点，位置x之前的read数(前缀和)就是x在数组中的插入位置，
+    任意以summit为中心的窗口内的read数都是两个前缀和之差，不需要再读reads文件或者重新统计
+    """
+    def __init__(self, reads_pos):
+        self._pos = {chrm: np.asarray(pos) for chrm, pos in reads_pos.items()}
+
+    def total(self):
+        return sum(pos.size for pos in self._pos.values())
+
+    def cumulative_counts(self, chrm, points):
+        """
+        :return: 染色体chrm上位置小于points的read数
+        """
+        points = np.asarray(points)
+        pos = self._pos.get(chrm)
+        if pos is None or pos.size == 0:
+            return np.zeros(points.shape, dtype=np.int64)
+        return np.searchsorted(pos, points.astype(pos.dtype, copy=False))
+
+    def window_counts(self, chrm, summits, exts):
+        """
+        一次查询同一组summit在多个延伸长度下窗口[summit - ext - 1, summit + ext]内的read数，
+        所有延伸长度的窗口边界合在一起只做一次二分查找
+        :return: (len(exts), len(summits))的read数数组
+        """
+        summits = np.asarray(summits)
+        exts = np.asarray(exts, dtype=np.int64).reshape(-1, 1)
+        bounds = np.concatenate((summits - exts - 1, summits + exts + 1))
+        cum = self.cumulative_counts(chrm, bounds.ravel()).reshape(bounds.shape)
+        return cum[exts.shape[0]:] - cum[:exts.shape[0]]
+
+
+# 计算read count时在升序的reads位点中二分查找，按实测的耗时约300条reads相当于一个peak的开销，
+# 用来估计传给map_chrms的数据量
+_READS_PER_PEAK_COST = 300
+
+
+def _reads_cost(reads_pos, chrms):
+    return sum(reads_pos[chrm].size for chrm in chrms if chrm in reads_pos) // _READS_PER_PEAK_COST
+
+
+def _chrm_window_reads(chrm, shared):
+    pks, reads_pos1, reads_pos2, ext = shared
+    return count_window_reads(pks.columns(chrm)['summit'], [reads_pos1.get(chrm), reads_pos2.get(chrm)], ext)
+
+
+def cal_peaks_read_density(pks, reads_pos1, reads_pos2, ext, processes=1):
+    """
+    计算pks中所有peak的read density
+    :param pks: PeakTable
+    :param reads_pos1: 样本1不同染色体reads的升序位点组成的字典
+    :param reads_pos2: 样本2不同染色体reads的升序位点组成的字典
+    :param processes: 按染色体并行计算的进程数
+    """
+    cost = get_peaks_size(pks) + _reads_cost(reads_pos1, pks.keys()) + _reads_cost(reads_pos2, pks.keys())
+    chrm_counts = map_chrms(_chrm_window_reads, pks.keys(), (pks, reads_pos1, reads_pos2, ext), processes, cost)
+    for key in pks.keys():
+        cols = pks.columns(key)
+        counts1, counts2 = chrm_counts[key]
+        # 加1是为了保证每个peak的read count初始为1
+        cols['read_count1'][:], cols['read_count2'][:] = counts1 + 1, counts2 + 1
+    cal_peaks_read_density_from_counts(pks, ext)
+
+
+def _chrm_sweep_reads(chrm, shared):
+    pks, coverage1, coverage2, exts = shared
+    summits = pks.columns(chrm)['summit']
+    return coverage1.window_counts(chrm, summits, exts), coverage2.window_counts(chrm, summits, exts)
+
+
+def cal_peaks_read_density_sweep(pks, coverage1, coverage2, exts, processes=1):
+    """
+    用两个样本的ReadsCoverage一次算出pks在多个延伸长度下的read density
+    :param exts: 延伸长度的列表
+    :return: 与exts一一对应的PeakTable(pks的副本)，read count, read density和M值、A值已经算好
+    """
+    cost = get_peaks_size(pks) * len(exts) + (coverage1.total() + coverage2.total()) // _READS_PER_PEAK_COST
+    chrm_counts = map_chrms(_chrm_sweep_reads, pks.keys(), (pks, coverage1, coverage2, exts), processes, cost)
+    tables = []
+    for i, ext in enumerate(exts):
+        table = pks.copy()
+        for key in table.keys():
+            cols = table.columns(key)
+            counts1, counts2 = chrm_counts[key]
+            cols['read_count1'][:], cols['read_count2'][:] = counts1[i] + 1, counts2[i] + 1
+        cal_peaks_read_density_from_counts(table, ext)
+        tables.append(table)
+    return tables
+
+
+def init_peaks_read_counts(pks):
+    """
+    逐条染色体累加read数之前，把两个样本的read count都设为初始值1
     """
-    i = 0
     for key in pks.keys():
-        for _ in pks[key]:
-            i += 1
-    return i
+        cols = pks.columns(key)
+        cols['read_count1'][:], cols['read_count2'][:] = 1, 1
 
 
-def cal_peaks_read_density(pks, reads_pos1, reads_pos2, ext):
+def cal_peaks_read_density_from_counts(pks, ext):
     """
-    计算pks字典中所有peak的read density
-    :param pks: pks字典
+    由已经计好的read count计算read density和M值、A值
     """
     for key in pks.keys():
-        [pk.cal_read_density(reads_pos1, reads_pos2, ext) for pk in pks[key]]
+        cols = pks.columns(key)
+        cols['read_density1'][:] = cols['read_count1'] * 1000. / (2. * ext)
+        cols['read_density2'][:] = cols['read_count2'] * 1000. / (2. * ext)
+        cols['mvalue'][:], cols['avalue'][:] = cal_mavalues(cols['read_density1'], cols['read_density2'])
 
 
 def normalize_peaks(pks, ma_fit):
     """
-    :param pks: peaks字典
+    :param pks: PeakTable
     :param ma_fit: 用来标准化peaks的M值和A值的模型参数
     """
     for key in pks.keys():
-        [pk.normalize_mavalue(ma_fit) for pk in pks[key]]
+        cols = pks.columns(key)
+        cols['normed_read_density1'][:], cols['normed_mvalue'][:], cols['normed_avalue'][:] = \
+            normalize_mavalues(cols['read_density1'], cols['read_density2'], ma_fit)
+        cols['pvalue'][:], cols['neg_log10_pvalue'][:] = cal_pvalues(cols['normed_read_density1'], cols['read_density2'])
 
 
-def get_common_peaks(pks1, pks2):
+def get_common_peaks(pks1, pks2, processes=1):
     """
     通过看两组peaks之间是否有重复区域找出pks1与pks2共有的peak
-    :param pks1: pks1字典
-    :param pks2: pks2字典
-    :return: common and unique peaks
+    :param pks1: PeakTable
+    :param pks2: PeakTable
+    :param processes: 按染色体并行计算的进程数
+    :return: common and unique peaks, 均为复制出来的PeakTable, 并标记了分组
     """
-    pks1_unique, pks1_common, pks2_unique, pks2_common = {}, {}, {}, {}
+    pks1_unique, pks1_common, pks2_unique, pks2_common = PeakTable(), PeakTable(), PeakTable(), PeakTable()
     common_chrm = set(pks1.keys()).intersection(pks2.keys())
     pks1_unique_chrm, pks2_unique_chrm = \
         set(pks1.keys()).difference(common_chrm), set(pks2.keys()).difference(common_chrm)
     for chrm in pks1_unique_chrm:
-        pks1_unique[chrm] = pks1[chrm]
+        _set_group_columns(pks1_unique, chrm, pks1.take(chrm, slice(None)), GROUP_UNIQUE)
     for chrm in pks2_unique_chrm:
-        pks2_unique[chrm] = pks2[chrm]
+        _set_group_columns(pks2_unique, chrm, pks2.take(chrm, slice(None)), GROUP_UNIQUE)
+    chrm_flags = map_chrms(_chrm_common_flags, common_chrm, (pks1, pks2), processes,
+                           get_peaks_size(pks1) + get_peaks_size(pks2))
     for chrm in common_chrm:
-        pks1_unique[chrm], pks1_common[chrm], pks2_unique[chrm], pks2_common[chrm] = \
-            __get_common_peaks(pks1[chrm], pks2[chrm])
+        flag1, flag2 = chrm_flags[chrm]
+        _set_group_columns(pks1_unique, chrm, pks1.take(chrm, ~flag1), GROUP_UNIQUE)
+        _set_group_columns(pks1_common, chrm, pks1.take(chrm, flag1), GROUP_COMMON)
+        _set_group_columns(pks2_unique, chrm, pks2.take(chrm, ~flag2), GROUP_UNIQUE)
+        _set_group_columns(pks2_common, chrm, pks2.take(chrm, flag2), GROUP_COMMON)
     return pks1_unique, pks1_common, pks2_unique, pks2_common
 
 
-def __get_common_peaks(pks1_chrm, pks2_chrm):
-    """
-    两组peaks同一条染色体中peaks内找common peaks
-    :param pks1_chrm: pks1的chri染色体上的peaks
-    :param pks2_chrm: pks2的chri染色体上的peaks
-    :return: common and unique peaks
-    """
-    flag1, flag2 = np.zeros(len(pks1_chrm)), np.zeros(len(pks2_chrm))
-    pks2_chrm_start = np.array([pk.start for pk in pks2_chrm])
-    pks2_chrm_end = np.array([pk.end for pk in pks2_chrm])
-    for i, pk in enumerate(pks1_chrm):
-        claus = 1.0 * (pk.end - pks2_chrm_start) * (pks2_chrm_end - pk.start)
-        overlap_locs = np.where(claus > 0)[0]
-        if overlap_locs.size > 0:
-            flag1[i] = 1
-            flag2[overlap_locs] = 1
+def _set_group_columns(pks, chrm, cols, group):
+    cols['group'][:] = group
+    pks.set_columns(chrm, cols)
 
-    pks1_chrm_unique, pks1_chrm_common = [], []
-    for i, v in enumerate(flag1):
-        pks1_chrm_unique.append(pks1_chrm[i]) if v == 0 else pks1_chrm_common.append(pks1_chrm[i])
 
-    pks2_chrm_unique, pks2_chrm_common = [], []
-    for i, v in enumerate(flag2):
-        pks2_chrm_unique.append(pks2_chrm[i]) if v == 0 else pks2_chrm_common.append(pks2_chrm[i])
+def _chrm_common_flags(chrm, shared):
+    pks1, pks2 = shared
+    return __get_common_peaks(pks1.columns(chrm), pks2.columns(chrm))
 
-    return pks1_chrm_unique, pks1_chrm_common, pks2_chrm_unique, pks2_chrm_common
+
+def __get_common_peaks(pks1_cols, pks2_cols):
+    """
+    两组peaks同一条染色体中peaks内找common peaks
+    :param pks1_cols: pks1的chri染色体上的peaks列
+    :param pks2_cols: pks2的chri染色体上的peaks列
+    :return: 两组peaks是否为common peak的布尔数组
+    """
+    flag1 = _overlap_flags(pks1_cols['start'], pks1_cols['end'], pks2_cols['start'], pks2_cols['end'])
+    flag2 = _overlap_flags(pks2_cols['start'], pks2_cols['end'], pks1_cols['start'], pks1_cols['end'])
+    return flag1, flag2
 
 
-def randomize_peaks(pks):
+def _overlap_flags(starts1, ends1, starts2, ends2):
+    """
+    判断每个区间1是否与至少一个区间2重叠，即存在start2 < end1且end2 > start1
+    (对start <= end的区间与(end1 - start2) * (end2 - start1) > 0等价)。
+    区间2按start排序后求end的前缀最大值，每个区间1只需一次二分查找，复杂度O((n + m)log m)
+    :return: 区间1是否重叠的布尔数组
+    """
+    flag = np.zeros(starts1.size, dtype=bool)
+    if starts2.size == 0:
+        return flag
+    order = np.argsort(starts2, kind='mergesort')
+    max_ends2 = np.maximum.accumulate(ends2[order])
+    # start2 < end1的区间2的个数
+    n_before = np.searchsorted(starts2[order], ends1, 'left')
+    has_before = n_before > 0
+    flag[has_before] = max_ends2[n_before[has_before] - 1] > starts1[has_before]
+    return flag
+
+
+def randomize_peaks(pks, rng=None):
     """
     通过随机模拟出和pks类似的random_pks
     :param pks: 被模拟的peaks
+    :param rng: np.random.RandomState, 为None时使用numpy的全局随机数
     :return: 模拟后的peaks
     """
-    randomized_pks = {}
+    rng = np.random if rng is None else rng
+    randomized_pks = PeakTable()
     for key in pks.keys():
-        randomized_pks[key] = []
-        pks_chrm = pks[key]
-        starts, ends = [pk.start for pk in pks_chrm], [pk.end for pk in pks_chrm]
-        lengths = [e - s for e, s in zip(ends, starts)]
-        min_start, max_end = min(starts), max(ends)
-        for length in lengths:
-            randomized_start = random.randint(min_start, max_end)
-            randomized_pks[key].append(Peak(key, randomized_start, randomized_start + length))
+        cols = pks.columns(key)
+        lengths = cols['end'] - cols['start']
+        randomized_starts = rng.randint(cols['start'].min(), cols['end'].max() + 1, size=lengths.size)
+        randomized_pks.add_chrm(key, randomized_starts, randomized_starts + lengths)
     return randomized_pks
 
 
-def merge_common_peaks(pks1_common, pks2_common):
+# 随机检验时每批处理的区间数上限，用来限制内存
+_PERMUTATION_BATCH_SIZE = 1 << 22
+
+
+def permutation_overlap_test(pks1, pks2, random_time, seed=None):
+    """
+    随机检验两组peaks的重叠是否富集：每次把pks2的peaks在各自染色体上随机放置（长度不变），
+    统计pks1中与随机peaks重叠的peak数。所有随机起点一次生成，
+    同一批的多次随机通过坐标平移放在一起，只需一次_overlap_flags就能得到各次的重叠数
+    :param random_time: 随机次数
+    :param seed: 随机数种子
+    :return: 每次随机的fold change数组, 经验p值
+    """
+    rng = np.random.RandomState(seed)
+    observed, random_counts = 0, np.zeros(random_time, dtype=np.int64)
+    for chrm in set(pks1.keys()).intersection(pks2.keys()):
+        cols1, cols2 = pks1.columns(chrm), pks2.columns(chrm)
+        starts1, ends1, starts2 = cols1['start'], cols1['end'], cols2['start']
+        lengths = cols2['end'] - starts2
+        if starts1.size == 0 or starts2.size == 0:
+            continue
+        observed += _overlap_flags(starts1, ends1, starts2, cols2['end']).sum()
+
+        min_start, max_end = starts2.min(), cols2['end'].max()
+        randomized_starts = rng.randint(min_start, max_end + 1, size=(random_time, starts2.size))
+        # 每次随机平移到互不重叠的坐标区段
+        base = min(starts1.min(), min_start)
+        span = max(ends1.max(), max_end + lengths.max()) - base + 1
+        batch = max(1, _PERMUTATION_BATCH_SIZE // (starts1.size + starts2.size))
+        for head in xrange(0, random_time, batch):
+            offsets = (np.arange(head, min(head + batch, random_time), dtype=np.int64) * span - base)[:, None]
+            batch_starts2 = randomized_starts[head:head + batch] + offsets
+            flags = _overlap_flags((starts1 + offsets).ravel(), (ends1 + offsets).ravel(),
+                                   batch_starts2.ravel(), (batch_starts2 + lengths).ravel())
+            random_counts[head:head + batch] += flags.reshape(offsets.size, starts1.size).sum(axis=1)
+    fcs = 1. * observed / (random_counts + 0.1)  # 加0.1避免出现分母为零的情况
+    pvalue = (1. + (random_counts >= observed).sum()) / (random_time + 1.)
+    return fcs, pvalue
+
+
+def _chrm_merged_peaks(chrm, shared):
+    pks1_common, pks2_common = shared
+    cols1, cols2 = pks1_common.columns(chrm), pks2_common.columns(chrm)
+    return merge_peak_arrays(*[np.concatenate((cols1[name], cols2[name])) for name in ('start', 'end', 'summit')])
+
+
+def merge_common_peaks(pks1_common, pks2_common, processes=1):
     """
     合并common peaks
+    :param processes: 按染色体并行计算的进程数
+    :return: 合并后的PeakTable, 以及{chrm: summit距离数组}
     """
-    merged_pks = {}
+    merged_pks = PeakTable()
     summit_dist = {}
+    chrm_merged = map_chrms(_chrm_merged_peaks, pks1_common.keys(), (pks1_common, pks2_common), processes,
+                             get_peaks_size(pks1_common) + get_peaks_size(pks2_common))
     for key in pks1_common.keys():
-        mix_pks_chrm = pks1_common[key] + pks2_common[key]
-        merged_pks[key], summit_dist[key] = __merge_sorted_peaks_list(_sort_peaks_list(mix_pks_chrm))
+        starts, ends, summits, summit_dist[key] = chrm_merged[key]
+        merged_pks.add_chrm(key, starts, ends, summits, GROUP_MERGED)
     return merged_pks, summit_dist
 
 
-def _sort_peaks_list(pks_list, start_or_summit='start'):
-    """
-    将peaks列表进行排序
-    """
-    if start_or_summit == 'start':
-        return [pks_list[loc] for loc in np.argsort([pk.start for pk in pks_list])]
-    elif start_or_summit == 'summit':
-        return [pks_list[loc] for loc in np.argsort([pk.summit for pk in pks_list])]
-
-
-def _add_peaks(pks1, pks2):
-    """
-    将peaks中对应的key的值扩展
-    :param pks1: peaks1字典
-    :param pks2: peaks2字典
-    :return: 新的peaks字典
-    """
-    peaks = {}
-    keys = set(pks1.keys() + pks2.keys())
-    for key in keys:
-        value = []
-        if key in pks1.keys():
-            value += pks1[key]
-        if key in pks2.keys():
-            value += pks2[key]
-        peaks[key] = value
-    return peaks
-
-
-def __merge_sorted_peaks_list(sorted_pks_list):
-    # print 'sorted peaks length: %d' % len(sorted_pks_list)
-    merged_pks, smt_dists = [], []
-
-    def get_a_merged_peak(head_loc):
-        # print head_loc
-        merged_pk_num = 0
-        merged_pk = sorted_pks_list[head_loc]
-        summits = [merged_pk.summit]
-        for pk in sorted_pks_list[head_loc + 1:]:
-            if merged_pk.isoverlap(pk):
-                merged_pk = Peak(pk.chrm, min(merged_pk.start, pk.start), max(merged_pk.end, pk.end))
-                summits.append(pk.summit)
-                merged_pk_num += 1
-            else:
-                # print summits
-                sorted_summits = sorted(summits)
-                smt_a, smt_b = get_summit(sorted_summits)
-                smt_dist = smt_b - smt_a
-                merged_pk.set_summit((smt_a + smt_b) / 2 + 1)
-                new_head_loc = head_loc + merged_pk_num + 1
-                return new_head_loc, merged_pk, smt_dist
-        sorted_summits = sorted(summits)
-        smt_a, smt_b = get_summit(sorted_summits)
-        smt_dist = smt_b - smt_a
-        merged_pk.set_summit((smt_a + smt_b) / 2 + 1)
-        new_head_loc = head_loc + merged_pk_num + 1
-        return new_head_loc, merged_pk, smt_dist
-
-    h_loc = 0
-    while h_loc < len(sorted_pks_list):
-        h_loc, m_pk, smt_d = get_a_merged_peak(h_loc)
-        merged_pks.append(m_pk)
-        smt_dists.append(smt_d)
-    return merged_pks, smt_dists
-
-
-def get_summit(sorted_summits):
-    smt_starts, smt_ends = sorted_summits[:-1], sorted_summits[1:]
-    smt_a, smt_b = smt_starts[0], smt_ends[0]
-    for s, e in zip(smt_starts, smt_ends):
-        if s - e < smt_a - smt_b:
-            smt_a, smt_b = s, e
-    return smt_a, smt_b
-
-
-def use_merged_peaks_fit_model(merged_pks, summit_dist, min_summit_dist):
+def merge_peak_arrays(starts, ends, summits, return_groups=False):
     """
-    利用合并后的peaks来拟合模型
+    按start排序后一次线性扫描合并一条染色体上相互重叠的peaks。
+    一个peak与前面所有peak的end的最大值重叠时并入当前的合并peak，否则开始新的合并peak；
+    合并peak的summit取其中距离最大的相邻summit对(有多对时取第一对)的中点，并给出这对summit的距离
+    :param return_groups: 是否同时返回每个输入peak所属的合并peak的下标
+    :return: 合并后的starts, ends, summits, summit之间的距离, 均为数组[, 输入peak所属的合并peak下标]
     """
-    selected_pks = {}
-    for key in merged_pks.keys():
-        selected_pks[key] = []
-        for pk, smt_d in zip(merged_pks[key], summit_dist[key]):
-            if smt_d <= min_summit_dist:
-                selected_pks[key].append(pk)
-    mvalues, avalues = get_peaks_mavalues(selected_pks)
-    fit_x = np.array(avalues)
-    fit_y = np.array(mvalues)
+    order = np.argsort(starts, kind='mergesort')
+    starts, ends, summits = starts[order], ends[order], summits[order]
+    if starts.size == 0:
+        if return_groups:
+            return starts, ends, summits, summits.copy(), np.zeros(0, dtype=np.int64)
+        return starts, ends, summits, summits.copy()
+    # 重叠：start落在当前合并peak内，或长度为0的peak正好落在其末端
+    max_ends = np.maximum.accumulate(ends)[:-1]
+    joined = (starts[1:] < max_ends) | ((starts[1:] == ends[1:]) & (ends[1:] == max_ends))
+    heads = np.concatenate(([0], np.flatnonzero(~joined) + 1))
+    group_ids = np.concatenate(([0], np.cumsum(~joined)))
+    merged_starts, merged_ends = starts[heads], np.maximum.reduceat(ends, heads)
+
+    # 每个合并peak内的summit升序排列后，在相邻的summit对中取距离最大的第一对
+    merged_summits, summit_dists = summits[heads].copy(), np.zeros(heads.size, dtype=summits.dtype)
+    sorted_summits = summits[np.lexsort((summits, group_ids))]
+    pair_locs = np.flatnonzero(group_ids[1:] == group_ids[:-1])
+    if pair_locs.size > 0:
+        pair_groups = group_ids[pair_locs]
+        pair_gaps = sorted_summits[pair_locs + 1] - sorted_summits[pair_locs]
+        group_max_gaps = np.zeros(heads.size, dtype=pair_gaps.dtype)
+        np.maximum.at(group_max_gaps, pair_groups, pair_gaps)
+        chosen = pair_gaps == group_max_gaps[pair_groups]
+        paired_groups, first = np.unique(pair_groups[chosen], return_index=True)
+        smt_a = sorted_summits[pair_locs[chosen][first]]
+        smt_b = sorted_summits[pair_locs[chosen][first] + 1]
+        merged_summits[paired_groups] = (smt_a + smt_b) // 2 + 1
+        summit_dists[paired_groups] = smt_b - smt_a
+    if return_groups:
+        groups = np.empty(order.size, dtype=np.int64)
+        groups[order] = group_ids
+        return merged_starts, merged_ends, merged_summits, summit_dists, groups
+    return merged_starts, merged_ends, merged_summits, summit_dists
+
+
+def _chrm_union_peaks(chrm, shared):
+    pks_list = shared
+    blocks = [(k, pks.columns(chrm)) for k, pks in enumerate(pks_list) if chrm in pks]
+    samples = np.concatenate([np.repeat(k, cols['start'].size) for k, cols in blocks])
+    starts, ends, summits, _, groups = merge_peak_arrays(
+        *[np.concatenate([cols[name] for _, cols in blocks]) for name in ('start', 'end', 'summit')],
+        return_groups=True)
+    peak_summits = np.concatenate([cols['summit'] for _, cols in blocks])
+    # 每个合并peak中每个样本只保留summit离合并peak的summit最近的那个peak
+    order = np.lexsort((np.abs(peak_summits - summits[groups]), samples, groups))
+    cells = groups[order] * len(pks_list) + samples[order]
+    first = np.concatenate(([True], cells[1:] != cells[:-1])) if cells.size else cells.astype(bool)
+    sample_summits = np.full((starts.size, len(pks_list)), -1, dtype=np.int64)
+    sample_summits[groups[order][first], samples[order][first]] = peak_summits[order][first]
+    return starts, ends, summits, sample_summits
+
+
+def build_union_peaks(pks_list, processes=1):
+    """
+    用merge_common_peaks的合并方法把多个样本的peaks合并成一组互不重叠的union peaks
+    :param pks_list: 各个样本的PeakTable
+    :return: union peaks的PeakTable, {chrm: (union peaks数, 样本数)的summit数组}，
+             样本在某个union peak中有peak时为它最接近union summit的那个peak的summit，没有时为-1
+    """
+    union_pks = PeakTable()
+    sample_summits = {}
+    chrms = sorted(set(chrm for pks in pks_list for chrm in pks.keys()))
+    chrm_union = map_chrms(_chrm_union_peaks, chrms, pks_list, processes,
+                           sum(get_peaks_size(pks) for pks in pks_list))
+    for key in chrms:
+        starts, ends, summits, sample_summits[key] = chrm_union[key]
+        union_pks.add_chrm(key, starts, ends, summits, GROUP_MERGED)
+    return union_pks, sample_summits
+
+
+def select_fit_peaks(merged_pks, summit_dist, min_summit_dist):
+    """
+    选出用来拟合模型的merged common peaks：两个summit的距离不超过min_summit_dist，且M值在[-10, 10]之间
+    :return: 这些peaks的A值, M值
+    """
+    selected = [summit_dist[key] <= min_summit_dist for key in merged_pks.keys()]
+    if selected:
+        selected = np.concatenate(selected)
+    fit_x = merged_pks.column('avalue')[selected]
+    fit_y = merged_pks.column('mvalue')[selected]
     idx_sel = np.where((fit_y >= -10) & (fit_y <= 10))[0]
+    return fit_x[idx_sel], fit_y[idx_sel]
+
 
-    # fit the model
-    x = sm.add_constant(fit_x[idx_sel])
-    y = fit_y[idx_sel]
-    ma_fit = sm.RLM(y, x).fit().params
+# Huber M估计的默认参数，与statsmodels RLM的默认设置(HuberT(t=1.345), scale_est='mad', conv='dev')一致
+HUBER_T = 1.345
+HUBER_MAXITER = 50
+HUBER_TOL = 1e-8
+# MAD的标准化常数，标准正态分布的3/4分位数
+_MAD_NORMALIZER = 0.6744897501960817
+
+
+def _weighted_line_fit(x, y, weights=None):
+    """
+    (加权)最小二乘拟合y = b * x + a
+    :return: a, b
+    """
+    if weights is None:
+        x_mean, y_mean = x.mean(), y.mean()
+        dx = x - x_mean
+        slope = np.dot(dx, y - y_mean) / np.dot(dx, dx)
+    else:
+        sum_w = weights.sum()
+        x_mean, y_mean = np.dot(weights, x) / sum_w, np.dot(weights, y) / sum_w
+        dx = x - x_mean
+        slope = np.dot(weights * dx, y - y_mean) / np.dot(weights * dx, dx)
+    return y_mean - slope * x_mean, slope
+
+
+def _huber_rho(z, t):
+    abs_z = np.fabs(z)
+    return np.where(abs_z <= t, 0.5 * z * z, abs_z * t - 0.5 * t * t)
+
+
+def huber_line_fit(x, y, t=HUBER_T, maxiter=HUBER_MAXITER, tol=HUBER_TOL, max_points=None, seed=0):
+    """
+    只用numpy的Huber M估计稳健直线拟合(迭代重加权最小二乘)，迭代过程与statsmodels的RLM(y, add_constant(x)).fit()相同：
+    从普通最小二乘开始，每次用Huber权重min(1, t / |r / s|)重新加权拟合，s为残差的MAD / 0.6745，
+    直到Huber偏差的变化不超过tol或达到maxiter次迭代
+    :param max_points: 点数超过max_points时先用固定的随机种子seed无放回地抽取max_points个点再拟合，结果可以重复
+    :return: (截距, 斜率)的数组, {'iterations': 迭代次数, 'converged': 是否收敛, 'points': 参与拟合的点数,
+             'total_points': 总点数, 'scale': 最后的残差尺度}
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    total = x.size
+    if max_points is not None and total > max_points:
+        idx = np.sort(np.random.RandomState(seed).choice(total, max_points, replace=False))
+        x, y = x[idx], y[idx]
+    df_resid = x.size - 2
+    if df_resid <= 0:
+        raise ValueError('at least 3 peaks are needed to fit the model, got %d' % x.size)
+
+    params = _weighted_line_fit(x, y)
+    resid = y - (params[1] * x + params[0])
+    scale = np.median(np.fabs(resid)) / _MAD_NORMALIZER
+    # 与RLM相同，收敛判断用的偏差以加权最小二乘的残差方差来标准化
+    deviance = _huber_rho(resid / (np.dot(resid, resid) / df_resid), t).sum()
+    iteration, converged = 1, False
+    while True:
+        abs_z = np.fabs(resid / scale)
+        weights = np.where(abs_z <= t, 1., t / np.maximum(abs_z, np.finfo(np.float64).tiny))
+        if not np.all(np.isfinite(weights)):
+            raise ValueError('invalid weights in the robust fit, the M values of the peaks may be all equal')
+        params = _weighted_line_fit(x, y, weights)
+        resid = y - (params[1] * x + params[0])
+        scale = np.median(np.fabs(resid)) / _MAD_NORMALIZER
+        prev_deviance = deviance
+        deviance = _huber_rho(resid / (np.dot(weights * resid, resid) / df_resid), t).sum()
+        iteration += 1
+        if np.fabs(deviance - prev_deviance) <= tol:
+            converged = True
+            break
+        if iteration >= maxiter:
+            break
+    info = {'iterations': iteration, 'converged': converged, 'points': x.size, 'total_points': total,
+            'scale': float(scale)}
+    return np.array(params), info
+
+
+def fit_ma_model(fit_x, fit_y, max_points=None, return_info=False):
+    """
+    用Huber稳健线性回归拟合M = ma_fit[1] * A + ma_fit[0]
+    :param max_points: 见huber_line_fit
+    :param return_info: 是否同时返回迭代次数、是否收敛等拟合信息
+    :return: ma_fit[, 拟合信息]
+    """
+    ma_fit, info = huber_line_fit(fit_x, fit_y, max_points=max_points)
+    if return_info:
+        return ma_fit, info
     return ma_fit
 
 
+def use_merged_peaks_fit_model(merged_pks, summit_dist, min_summit_dist, max_points=None, return_info=False):
+    """
+    利用合并后的peaks来拟合模型
+    :param max_points: 参与拟合的peaks超过这个数量时按固定的随机种子抽样
+    :param return_info: 是否同时返回拟合信息，见huber_line_fit
+    """
+    fit_x, fit_y = select_fit_peaks(merged_pks, summit_dist, min_summit_dist)
+    return fit_ma_model(fit_x, fit_y, max_points, return_info)
+
+
+def format_ma_model(slope, intercept):
+    """
+    :return: 'M = slope * A + intercept'，截距为负时写成'- |intercept|'
+    """
+    return 'M = %f * A %s %f' % (slope, '+' if intercept >= 0 else '-', abs(intercept))
+
+
 def get_peaks_mavalues(pks):
     """
     返回peaks所有的m, a值对
-    :param pks: peaks字典
+    :param pks: PeakTable
     :return: mvalues, avalues
     """
-    mvalues, avalues = [], []
-    for key in pks.keys():
-        for pk in pks[key]:
-            mvalues.append(pk.mvalue), avalues.append(pk.avalue)
-
-    return mvalues, avalues
+    return pks.column('mvalue'), pks.column('avalue')
 
 
 def get_peaks_normed_mavalues(pks):
     """
     返回peaks normalization之后所有的m, a值对
-    :param pks: peaks字典
+    :param pks: PeakTable
     :return: normed_mvalues, normed_avalues
     """
-    normed_mvalues, normed_avalues = [], []
-    for key in pks.keys():
-        for pk in pks[key]:
-            normed_mvalues.append(pk.normed_mvalue), normed_avalues.append(pk.normed_avalue)
-
-    return normed_mvalues, normed_avalues
+    return pks.column('normed_mvalue'), pks.column('normed_avalue')
 
 
 def get_peaks_pvalues(pks):
     """
     返回peaks normalization之后所有的p值
-    :param pks: peaks字典
+    :param pks: PeakTable
     :return: pvalues
     """
-    pvalues = []
-    for key in pks.keys():
-        for pk in pks[key]:
-            pvalues.append(pk.pvalue)
-
-    return pvalues
\ No newline at end of file
+    return pks.column('pvalue')
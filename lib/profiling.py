@@ -0,0 +1,130 @@
+# coding=utf-8
+# 记录每个步骤的耗时、内存和处理的数据量，输出JSON格式的运行报告
+import json
+import os
+import resource
+import sys
+import time
+
+
+def _peak_rss_mb():
+    """
+    :return: 当前进程和已结束的子进程的峰值常驻内存(MB)
+    """
+    # Linux上ru_maxrss的单位是KB，Mac OS X上是字节
+    unit = 1024. * 1024. if sys.platform == 'darwin' else 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+
+
+def _cpu_time():
+    """
+    :return: 当前进程和已结束的子进程的CPU时间(user + sys, s)
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+class _Stage(object):
+    def __init__(self, report, name, counts):
+        self.report = report
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        self.report.begin(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.report.end(self.name, **self.counts)
+        return False
+
+
+class RunReport(object):
+    """
+    按步骤记录墙上时间、CPU时间(含子进程)、峰值内存和处理的peaks, reads数量：
+
+        report = RunReport()
+        with report.stage('overlap', peaks=n):
+            ...
+        report.add_counts('overlap', common=m)
+        report.write('run_report.json')
+
+    profile为True时用cProfile记录各个步骤(只包括当前进程)，dump_profile写出结果
+    """
+    def __init__(self, profile=False):
+        self.stages = []
+        self.info = {}
+        self._open = {}
+        self._start_wall = time.time()
+        self._start_cpu = _cpu_time()
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def stage(self, name, **counts):
+        return _Stage(self, name, counts)
+
+    def begin(self, name):
+        """
+        开始一个步骤，begin和end之间可以有其它步骤(比如在子进程中作图的同时输出文件)
+        """
+        self._open[name] = (time.time(), _cpu_time())
+        if self.profiler is not None and len(self._open) == 1:
+            self.profiler.enable()
+
+    def end(self, name, **counts):
+        start_wall, start_cpu = self._open.pop(name)
+        if self.profiler is not None and not self._open:
+            self.profiler.disable()
+        rss, children_rss = _peak_rss_mb()
+        self.stages.append({
+            'name': name,
+            'wall_time': time.time() - start_wall,
+            'cpu_time': _cpu_time() - start_cpu,
+            'peak_rss_mb': rss,
+            'children_peak_rss_mb': children_rss,
+            'counts': counts,
+        })
+
+    def add_counts(self, name, **counts):
+        """
+        给已经结束的步骤补充数量，比如步骤的输出
+        """
+        for stage in reversed(self.stages):
+            if stage['name'] == name:
+                stage['counts'].update(counts)
+                return
+
+    def wall_time(self):
+        return time.time() - self._start_wall
+
+    def to_dict(self):
+        rss, children_rss = _peak_rss_mb()
+        report = dict(self.info)
+        report.update({
+            'wall_time': self.wall_time(),
+            'cpu_time': _cpu_time() - self._start_cpu,
+            'peak_rss_mb': rss,
+            'children_peak_rss_mb': children_rss,
+            'stages': self.stages,
+        })
+        return report
+
+    def write(self, report_fp):
+        with open(report_fp, 'w') as fo:
+            json.dump(self.to_dict(), fo, indent=2, sort_keys=True)
+
+    def dump_profile(self, prof_fp, stats_fp=None, limit=40):
+        """
+        写出cProfile的结果(可以用pstats或snakeviz查看)，stats_fp给出时再写一份按累计时间排序的文本
+        """
+        if self.profiler is None:
+            return
+        self.profiler.dump_stats(prof_fp)
+        if stats_fp is not None:
+            import pstats
+            with open(stats_fp, 'w') as fo:
+                pstats.Stats(prof_fp, stream=fo).sort_stats('cumulative').print_stats(limit)